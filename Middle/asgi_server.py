@@ -0,0 +1,278 @@
+"""
+Async serving mode, same routes as server.py:
+    uvicorn asgi_server:app --host 0.0.0.0 --port 5000
+Handlers await the LLM instead of holding a thread per request, so idle and waiting connections are cheap.
+At most MAX_CONCURRENT_TURNS turns run at once, up to MAX_QUEUED_TURNS more wait for a slot, anything beyond
+that gets a 429 (and a wait longer than QUEUE_WAIT_SECONDS a 503), both with Retry-After.
+A turn that takes longer than REQUEST_TIMEOUT_SECONDS, or whose client disconnects, is cancelled,
+which cancels the LLM call in flight. On shutdown new requests get a 503, running turns get DRAIN_SECONDS
+to finish, then every session is closed (pending learning is flushed and Memory written to disk).
+"""
+from dotenv import load_dotenv
+from session_module import SessionPool, valid_user_id
+from metrics_module import metrics
+from routing_module import shared_router
+from prompt_module import prompts
+import asyncio
+import json
+import math
+import os
+import time
+
+load_dotenv()
+
+
+class Rejected(Exception):
+    def __init__(self, status, retry_after):
+        super().__init__(f"{status}, retry after {retry_after}s")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionQueue:
+    """
+    Bounded admission for turns: max_concurrent running, max_waiting queued, the rest rejected right away.
+    Retry-After is estimated from the queue length and the recent average turn time.
+    Has to be created on the serving event loop.
+    """
+    def __init__(self, max_concurrent=16, max_waiting=64, wait_timeout=10.0):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.waiting = 0
+        self.running = 0
+        self.avg_seconds = 2.0 # moving average of turn time, a guess until the first turns finish
+        self.closed = False
+        self.idle = asyncio.Event() # set whenever nothing is running
+        self.idle.set()
+
+    def retry_after(self):
+        return max(1, math.ceil((self.waiting + 1) * self.avg_seconds / self.max_concurrent))
+
+    async def acquire(self):
+        if self.closed:
+            raise Rejected(503, 5)
+        if not self.slots.locked():
+            # A free slot and nobody ahead, this doesn't wait and doesn't count against max_waiting
+            await self.slots.acquire()
+            self.running += 1
+            self.idle.clear()
+            return
+        if self.waiting >= self.max_waiting:
+            metrics.count("requests_rejected_total")
+            raise Rejected(429, self.retry_after())
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            metrics.count("requests_rejected_total")
+            raise Rejected(503, self.retry_after())
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        self.idle.clear()
+
+    def release(self, seconds):
+        self.avg_seconds = 0.2 * seconds + 0.8 * self.avg_seconds
+        self.running -= 1
+        if self.running == 0:
+            self.idle.set()
+        self.slots.release()
+
+    async def drain(self, timeout):
+        self.closed = True
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Shutting down with {self.running} turns still running")
+
+    def render(self, prefix="him"):
+        return (f"# TYPE {prefix}_admission_running gauge\n{prefix}_admission_running {self.running}\n"
+                f"# TYPE {prefix}_admission_waiting gauge\n{prefix}_admission_waiting {self.waiting}\n")
+
+
+CORS_HEADERS = [(b"access-control-allow-origin", b"*"),
+                (b"access-control-allow-headers", b"content-type, x-session-id, x-user-id"),
+                (b"access-control-allow-methods", b"GET, POST, OPTIONS")]
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+async def send_response(send, status, body, content_type=b"application/json", headers=()):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())] + CORS_HEADERS + list(headers)})
+    await send({"type": "http.response.body", "body": body})
+
+async def send_json(send, status, obj, headers=()):
+    await send_response(send, status, json.dumps(obj).encode(), headers=headers)
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+class ChatApp:
+    """
+    Plain ASGI app (no framework), serving /chat, /chat/stream, /prefetch and /metrics
+    """
+    def __init__(self, pool: SessionPool, max_concurrent=16, max_waiting=64, wait_timeout=10.0, request_timeout=60.0, drain_timeout=30.0):
+        self.pool = pool
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.request_timeout = request_timeout
+        self.drain_timeout = drain_timeout
+        self.admission = None # created on the serving loop, at startup (or on the first request)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        if self.admission is None:
+            self.admission = AdmissionQueue(self.max_concurrent, self.max_waiting, self.wait_timeout)
+        method, path = scope["method"], scope["path"]
+        if method == "OPTIONS":
+            return await send_response(send, 204, b"")
+        if path == "/metrics" and method == "GET":
+            # Per-stage latency histograms, token and failure counters, per-route cost, per-prompt tokens and prefix reuse, admission gauges
+            text = metrics.render() + shared_router().render() + prompts.render_metrics() + self.admission.render()
+            return await send_response(send, 200, text.encode(), content_type=b"text/plain; version=0.0.4")
+        if path in ("/chat", "/chat/stream") and method == "POST":
+            return await self.chat(scope, receive, send, stream=path == "/chat/stream")
+        if path == "/prefetch" and method == "POST":
+            return await self.prefetch(scope, receive, send)
+        await send_json(send, 404, {"error": "Not found"})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.admission = AdmissionQueue(self.max_concurrent, self.max_waiting, self.wait_timeout)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def shutdown(self):
+        if self.admission is not None:
+            await self.admission.drain(self.drain_timeout)
+        # Finishes pending learning and writes every user's Memory to disk
+        await asyncio.to_thread(self.pool.close_all)
+
+    def session_ids(self, scope, data):
+        # Session/user ids can come in the body or as headers, everything else falls back to the single default user
+        headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        session_id = data.get("session_id") or headers.get("x-session-id", "default")
+        user_id = data.get("user_id") or headers.get("x-user-id", "default")
+        return str(session_id), str(user_id)
+
+    async def read_message(self, receive, send):
+        # JSON body with a "message", None if the client left or (after answering 400) if it's missing
+        body = await read_body(receive)
+        if body is None:
+            return None
+        try:
+            data = json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            data = None
+        if not isinstance(data, dict) or "message" not in data:
+            await send_json(send, 400, {"error": "Missing message"})
+            return None
+        return data
+
+    async def prefetch(self, scope, receive, send):
+        # Speculation runs on the session's own worker at background priority, so it skips admission
+        data = await self.read_message(receive, send)
+        if data is None:
+            return
+        if self.admission.closed:
+            return await send_json(send, 503, {"error": "Shutting down"})
+        session_id, user_id = self.session_ids(scope, data)
+        if not valid_user_id(user_id):
+            return await send_json(send, 400, {"error": "Invalid user id"})
+        session = await asyncio.to_thread(self.pool.get, session_id, user_id)
+        started = session.talker.prefetch(str(data["message"]))
+        await send_json(send, 202, {"started": started})
+
+    async def chat(self, scope, receive, send, stream):
+        data = await self.read_message(receive, send)
+        if data is None:
+            return
+        session_id, user_id = self.session_ids(scope, data)
+        if not valid_user_id(user_id):
+            return await send_json(send, 400, {"error": "Invalid user id"})
+
+        try:
+            await self.admission.acquire()
+        except Rejected as e:
+            return await send_json(send, e.status, {"error": "Too busy, try again later"},
+                                   headers=[(b"retry-after", str(e.retry_after).encode())])
+        started = time.perf_counter()
+        try:
+            if stream:
+                await self.run_cancellable(receive, self.stream_turn(send, session_id, user_id, data["message"]), send, headers_sent=True)
+            else:
+                await self.run_cancellable(receive, self.turn(send, session_id, user_id, data["message"]), send)
+        finally:
+            self.admission.release(time.perf_counter() - started)
+
+    async def run_cancellable(self, receive, coro, send, headers_sent=False):
+        """
+        Runs one turn until it finishes, times out or the client goes away (cancelling it in the last two cases)
+        """
+        turn = asyncio.ensure_future(coro)
+        watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+        done, _ = await asyncio.wait({turn, watcher}, timeout=self.request_timeout, return_when=asyncio.FIRST_COMPLETED)
+        watcher.cancel()
+        if turn in done:
+            turn.result()
+            return
+        turn.cancel()
+        try:
+            await turn
+        except asyncio.CancelledError:
+            pass
+        if watcher in done:
+            metrics.count("requests_disconnected_total")
+            return
+        metrics.count("requests_timed_out_total")
+        if headers_sent:
+            await send({"type": "http.response.body", "body": b'event: error\ndata: {"error": "Timed out"}\n\n'})
+        else:
+            await send_json(send, 504, {"error": "Timed out"})
+
+    async def turn(self, send, session_id, user_id, message):
+        async with self.pool.session_async(session_id, user_id) as talker:
+            response = await talker.process_query_async(message)
+        await send_json(send, 200, {"response": response})
+
+    async def stream_turn(self, send, session_id, user_id, message):
+        # Server-sent events: one "data:" event per chunk of the reply, then a "done" event
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"),
+                                (b"x-accel-buffering", b"no")] + CORS_HEADERS})
+        async with self.pool.session_async(session_id, user_id) as talker:
+            async for chunk in talker.process_query_stream_async(message):
+                await send({"type": "http.response.body", "body": f"data: {json.dumps({'token': chunk})}\n\n".encode(), "more_body": True})
+        await send({"type": "http.response.body", "body": b"event: done\ndata: {}\n\n"})
+
+
+# One Conversationalist per session, Memory per user, both created on first use
+app = ChatApp(SessionPool(os.getenv("GROQ_API_KEY"), max_sessions=int(os.getenv("MAX_SESSIONS", "32"))),
+              max_concurrent=int(os.getenv("MAX_CONCURRENT_TURNS", "16")),
+              max_waiting=int(os.getenv("MAX_QUEUED_TURNS", "64")),
+              wait_timeout=float(os.getenv("QUEUE_WAIT_SECONDS", "10")),
+              request_timeout=float(os.getenv("REQUEST_TIMEOUT_SECONDS", "60")),
+              drain_timeout=float(os.getenv("DRAIN_SECONDS", "30")))
@@ -0,0 +1,184 @@
+"""
+Offline benchmarks, no Groq calls: every LLM call goes to FakeGroqAgent.
+    python benchmark.py --sizes 10,100,1000 --turns 30 --latency 0.05
+Reports p50/p95 latency, LLM calls and prompt tokens per turn, and RSS for each KB size.
+"""
+from fake_llm import FakeGroqAgent
+from processing_module import Conversationalist
+from retrieval_module import Memory
+from learning_module import Learner
+from migrate_kb import migrate
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import tempfile
+import time
+
+WORDS = ("work", "gym", "sister", "trip", "guitar", "exam", "startup", "coffee", "football", "movie", "mom", "dad",
+         "project", "deadline", "friend", "birthday", "college", "coding", "running", "cooking", "book", "travel",
+         "salary", "interview", "doctor", "sleep", "music", "party", "bike", "rent")
+
+SAMPLE_QUERIES = ("I went to the gym today and my knee hurts again",
+                  "My sister has her exam tomorrow, she's really stressed",
+                  "Started learning guitar, it's harder than I thought",
+                  "Had an interview for the startup job, fingers crossed",
+                  "Watched a great movie with friends last night",
+                  "Can't sleep, thinking about the project deadline",
+                  "Mom's birthday is next week, no idea what to get her",
+                  "hey, what's up")
+
+def make_synthetic_kb(num_facts, fields_per_domain=20, words_per_fact=12, seed=0):
+    """
+    A KB in the KB/permanent.json schema with roughly num_facts facts
+    """
+    rng = random.Random(seed)
+    num_domains = max(1, num_facts // fields_per_domain)
+    data, fields_info = {}, {}
+    for d in range(num_domains):
+        domain = f"{WORDS[d % len(WORDS)]}{d}"
+        fields = {"general": " ".join(rng.choices(WORDS, k=words_per_fact))}
+        for f in range(min(fields_per_domain, num_facts - d * fields_per_domain)):
+            fields[f"{rng.choice(WORDS)}_{f}"] = " ".join(rng.choices(WORDS, k=words_per_fact))
+        data[domain] = fields
+        fields_info[domain] = len(fields)
+    return {
+        "volatility": "permanent",
+        "fields_info": fields_info,
+        "bio_data": {"name": "Bench", "preferred_lang": "English", "alt_langs": [], "DOB": "01/01/2000"},
+        "data": data,
+        "convo_starter": {"general_info": "Likes benchmarks", "prev_context": "Talked about latency"}
+    }
+
+def write_kb(kb, directory):
+    path = os.path.join(directory, "permanent.json")
+    with open(path, "w") as file:
+        json.dump(kb, file)
+    return path
+
+def rss_mb():
+    # Current RSS from /proc where available, peak RSS otherwise
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def summarize(name, size, timings, llm=None, turns=None):
+    timings = sorted(timings)
+    result = {
+        "bench": name,
+        "kb_facts": size,
+        "runs": len(timings),
+        "p50_ms": round(1000 * statistics.median(timings), 3),
+        "p95_ms": round(1000 * timings[min(len(timings) - 1, int(0.95 * len(timings)))], 3),
+        "rss_mb": round(rss_mb(), 1)
+    }
+    if llm is not None and turns:
+        calls, tokens = llm.totals()
+        result["calls_per_turn"] = round(calls / turns, 2)
+        result["prompt_tokens_per_turn"] = round(tokens / turns, 1)
+    return result
+
+def bench_startup(path, size, repeats, name="startup"):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        Memory(FakeGroqAgent(), path_to_permanent_data=path)
+        timings.append(time.perf_counter() - start)
+    return summarize(name, size, timings)
+
+def bench_retrieve(path, size, repeats, latency, mode):
+    llm = FakeGroqAgent(latency=latency)
+    memory = Memory(llm, path_to_permanent_data=path, retrieval_mode=mode)
+    timings = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        memory.retrieve(SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)])
+        timings.append(time.perf_counter() - start)
+    return summarize(f"retrieve[{mode}]", size, timings, llm, repeats)
+
+def bench_learn(path, size, repeats, latency):
+    llm = FakeGroqAgent(latency=latency)
+    memory = Memory(llm, path_to_permanent_data=path)
+    learner = Learner(memory, llm)
+    timings = []
+    for i in range(repeats):
+        query = SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)]
+        start = time.perf_counter()
+        learner.learn_from_query(query, memory.retrieve(query))
+        timings.append(time.perf_counter() - start)
+    return summarize("learn_from_query", size, timings, llm, repeats)
+
+def bench_write(path, size, repeats):
+    memory = Memory(FakeGroqAgent(), path_to_permanent_data=path)
+    domain = memory.top_level_fields[0]
+    timings = []
+    for i in range(repeats):
+        memory.change_subfield_and_fact(domain, f"bench_{i}", "a freshly learned fact", to_add=True)
+        start = time.perf_counter()
+        memory.write_to_disk()
+        timings.append(time.perf_counter() - start)
+    return summarize("write_to_disk", size, timings)
+
+def bench_turns(directory, size, turns, latency, mode, planner=False):
+    llm = FakeGroqAgent(latency=latency)
+    talker = Conversationalist(llm=llm, kb_path=os.path.join(directory, "permanent.json"), retrieval_mode=mode, planner=planner)
+    timings = []
+    for i in range(turns):
+        start = time.perf_counter()
+        talker.process_query(SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)])
+        timings.append(time.perf_counter() - start)
+    talker.end_convo() # learning is background work, but its calls still count towards the turns
+    talker.close()
+    return summarize(f"process_query[{mode}{'+planner' if planner else ''}]", size, timings, llm, turns)
+
+def run(sizes, turns, repeats, latency):
+    results = []
+    for size in sizes:
+        directory = tempfile.mkdtemp(prefix="him_bench_")
+        try:
+            kb = make_synthetic_kb(size)
+            path = write_kb(kb, directory)
+            results.append(bench_startup(path, size, max(3, repeats // 10)))
+            sharded_dir, _ = migrate(path, os.path.join(directory, "sharded"), keep=True)
+            results.append(bench_startup(sharded_dir, size, max(3, repeats // 10), "startup[sharded]"))
+            results.append(bench_retrieve(sharded_dir, size, repeats, latency, "index"))
+            results[-1]["bench"] = "retrieve[index+sharded]"
+            for mode in ("index", "llm"):
+                results.append(bench_retrieve(path, size, repeats, latency, mode))
+            results.append(bench_learn(path, size, min(repeats, turns), latency))
+            write_kb(kb, directory) # undo what learning added
+            results.append(bench_write(path, size, repeats))
+            for mode, planner in (("index", False), ("llm", False), ("llm", True)):
+                write_kb(kb, directory)
+                if os.path.exists(path + ".wal"):
+                    os.remove(path + ".wal")
+                results.append(bench_turns(directory, size, turns, latency, mode, planner))
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+def print_table(results):
+    columns = ("bench", "kb_facts", "runs", "p50_ms", "p95_ms", "calls_per_turn", "prompt_tokens_per_turn", "rss_mb")
+    print(" ".join(f"{c:>22}" for c in columns))
+    for row in results:
+        print(" ".join(f"{str(row.get(c, '-')):>22}" for c in columns))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks with a fake LLM backend")
+    parser.add_argument("--sizes", default="10,100,1000", help="comma separated KB sizes (number of facts)")
+    parser.add_argument("--turns", type=int, default=20, help="turns per end-to-end run")
+    parser.add_argument("--repeats", type=int, default=50, help="repetitions for the micro benchmarks")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake LLM latency per call, in seconds")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = run([int(s) for s in args.sizes.split(",")], args.turns, args.repeats, args.latency)
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=4)
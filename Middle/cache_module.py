@@ -0,0 +1,89 @@
+from collections import OrderedDict
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+class ResponseCache:
+    """
+    Two-tier cache for LLM responses: an in-memory LRU (bounded by size and TTL)
+    in front of an sqlite file that survives restarts.
+    Only low temperature (near deterministic) queries are cached, see max_temp.
+    """
+    def __init__(self, max_entries=1024, ttl=7 * 24 * 3600, max_temp=0.3, disk_path="./llm_cache.sqlite"):
+        self.max_entries = max_entries
+        self.ttl = ttl # seconds
+        self.max_temp = max_temp
+        self.entries = OrderedDict() # key -> (created_at, response)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db = None
+        if disk_path is not None:
+            self.db = sqlite3.connect(disk_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, created REAL, response TEXT)")
+            self.db.commit()
+
+    def cacheable(self, temp):
+        return temp <= self.max_temp
+
+    def make_key(self, model, lang, system_prompt, prompt, temp):
+        raw = json.dumps([model, lang, system_prompt, prompt, temp])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            if key in self.entries:
+                created, response = self.entries[key]
+                if now - created <= self.ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return response
+                del self.entries[key]
+
+            if self.db is not None:
+                row = self.db.execute("SELECT created, response FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[0] <= self.ttl:
+                    response = tuple(json.loads(row[1]))
+                    self._remember(key, row[0], response)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return response
+
+            self.misses += 1
+            return None
+
+    def put(self, key, response):
+        now = time.time()
+        with self.lock:
+            self._remember(key, now, response)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, now, json.dumps(response)))
+                self.db.commit()
+
+    def _remember(self, key, created, response):
+        self.entries[key] = (created, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def prune(self):
+        """
+        Drops expired entries from disk, the in-memory tier expires lazily
+        """
+        if self.db is not None:
+            with self.lock:
+                self.db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+                self.db.commit()
+
+    def stats(self):
+        return {
+            "cache_hits": self.hits,
+            "cache_disk_hits": self.disk_hits,
+            "cache_misses": self.misses,
+            "cache_entries": len(self.entries)
+        }
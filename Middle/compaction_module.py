@@ -0,0 +1,116 @@
+from context_module import count_tokens, truncate_to_tokens
+from index_module import tokenize
+from rate_limit_module import PRIORITY_BACKGROUND
+from metrics_module import metrics
+from prompt_module import prompts
+import re
+import time
+
+# Facts in one field are stored as fragments joined by this, newest last
+FRAGMENT_SEPARATOR = "; "
+
+def split_fragments(text):
+    # Older KBs glued fragments together with newlines (or nothing at all), those are split as well as we can
+    return [fragment.strip() for fragment in re.split(r";\s|\n", text or "") if fragment.strip()]
+
+def similarity(a, b):
+    # Jaccard overlap of the content words
+    a, b = set(tokenize(a)), set(tokenize(b))
+    if not a or not b:
+        return 1.0 if a == b else 0.0
+    return len(a & b) / len(a | b)
+
+def dedup_fragments(fragments, threshold=0.8):
+    """
+    Drops exact and near-duplicate fragments. When two are near-duplicates the later one is kept
+    (in the later position), since it's the most recent way the user put it.
+    """
+    kept = []
+    for fragment in fragments:
+        kept = [old for old in kept if old.lower() != fragment.lower() and similarity(old, fragment) < threshold]
+        kept.append(fragment)
+    return kept
+
+def merge_fragments(existing, new, threshold=0.8):
+    """
+    Value of a field after adding new to existing, with a separator and without repeats
+    """
+    return FRAGMENT_SEPARATOR.join(dedup_fragments(split_fragments(existing) + split_fragments(new), threshold))
+
+def clip_fact(text, max_tokens):
+    # Newest fragments last, so those are the ones that survive
+    if max_tokens is None or count_tokens(text) <= max_tokens:
+        return text
+    return FRAGMENT_SEPARATOR.join(truncate_to_tokens("\n".join(split_fragments(text)), max_tokens, keep_end=True).split("\n"))
+
+
+class FactCompactor:
+    """
+    Keeps fields from growing without bound as the KB matures.
+    Memory tracks the size and age of every field; fields that got too big (and haven't been written to
+    for min_idle_seconds) are de-duplicated locally, and if they're still over max_field_tokens,
+    summarized by the LLM at background priority. The old value is archived to the KB's history file
+    and the field's version is bumped.
+    Meant to run on the learning worker, after learning, so it never races with learned writes.
+    """
+    def __init__(self, memory, llm, max_field_tokens=120, min_idle_seconds=60.0, per_run=4):
+        self.mem = memory
+        self.llm = llm
+        self.max_field_tokens = max_field_tokens
+        self.min_idle_seconds = min_idle_seconds
+        self.per_run = per_run # fields compacted per run at most, so one run never hogs the background budget
+
+    def candidates(self):
+        """
+        (domain, field) pairs over the size threshold, biggest first
+        """
+        now = time.time()
+        # ~4 chars a token, the exact count is only taken for the fields that make it through here
+        min_chars = self.max_field_tokens * 4
+        with self.mem.lock:
+            found = [(meta["chars"], domain, field)
+                     for domain, fields in self.mem.field_meta.items()
+                     for field, meta in fields.items()
+                     if meta["chars"] > min_chars and now - meta["updated"] >= self.min_idle_seconds
+                     and meta.get("compacted_chars") != meta["chars"]]
+        return [(domain, field) for _, domain, field in sorted(found, reverse=True)]
+
+    def _summarize(self, domain, field, fragments):
+        facts = "\n".join(fragments)
+        max_words = max(10, int(self.max_field_tokens * 0.6))
+        prompt = prompts.render("fact_compaction", max_words=max_words, domain=domain, field=field, facts=facts)
+        (_, resp, _) = self.llm.make_query(prompt, temp=0.1, priority=PRIORITY_BACKGROUND, stage="fact_compaction")
+        match = re.search(r"<SUM>(.*?)<SUM>", resp, re.DOTALL) if resp is not None else None
+        if match is None or match.group(1).strip() == "":
+            return None
+        return match.group(1).strip()
+
+    def compact_field(self, domain, field):
+        """
+        Returns True if the field was rewritten
+        """
+        with self.mem.lock:
+            value = self.mem.data[domain][field]
+        fragments = dedup_fragments(split_fragments(value))
+        compacted = FRAGMENT_SEPARATOR.join(fragments)
+        if count_tokens(compacted) > self.max_field_tokens:
+            summary = self._summarize(domain, field, fragments)
+            # If the LLM is unavailable, fall back to keeping the newest fragments that fit
+            compacted = summary if summary is not None else clip_fact(compacted, self.max_field_tokens)
+        if compacted == value:
+            self.mem.mark_compacted(domain, field) # nothing to do, don't look at it again until it changes
+            return False
+        return self.mem.replace_compacted(domain, field, value, compacted)
+
+    def run(self):
+        """
+        Compacts up to per_run fields, returns how many were rewritten
+        """
+        compacted = 0
+        for domain, field in self.candidates()[:self.per_run]:
+            with metrics.stage("fact_compaction_job"):
+                if self.compact_field(domain, field):
+                    compacted += 1
+        if compacted:
+            metrics.count("fields_compacted_total", compacted)
+        return compacted
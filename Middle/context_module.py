@@ -0,0 +1,134 @@
+from collections import deque
+import re
+import threading
+
+# Optional: exact token counts with tiktoken, otherwise a word/punctuation approximation
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+def count_tokens(text):
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # ~1 token per word or punctuation mark, long words count a bit more
+    return sum(1 + len(piece) // 8 for piece in re.findall(r"\w+|[^\w\s]", text))
+
+def truncate_to_tokens(text, budget, keep_end=False):
+    # Keeps whole lines from the top (or the bottom) while they fit
+    lines = text.split("\n")
+    if keep_end:
+        lines.reverse()
+    kept, used = [], 0
+    for line in lines:
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            if not kept:
+                # A single line that's too long on its own, cut it down word by word
+                words = line.split(" ")
+                while words and count_tokens(" ".join(words)) + 1 > budget:
+                    words = words[1:] if keep_end else words[:-1]
+                kept.append(" ".join(words))
+            break
+        kept.append(line)
+        used += cost
+    if keep_end:
+        kept.reverse()
+    return "\n".join(kept)
+
+
+class ContextManager:
+    """
+    Token-budgeted conversation context.
+    Recent turns are kept verbatim (up to history_budget tokens) and rendered incrementally.
+    Turns that fall out of the window aren't dropped, they're folded into a hierarchical rolling summary:
+    evicted lines pile up in level 0, and whenever a level goes over its budget it's summarized
+    into one entry of the level above. The top level is re-summarized into itself.
+    fold() does the (LLM) summarizing and is meant to be run off the critical path.
+    """
+    def __init__(self, history_budget=1500, summary_budget=400, prompt_budget=3000, summarizer=None, levels=3):
+        self.history_budget = history_budget
+        self.summary_budget = summary_budget # per level
+        self.prompt_budget = prompt_budget
+        self.summarizer = summarizer # text, token budget -> summary (or None on failure)
+        self.turns = deque() # (line, tokens)
+        self.history_tokens = 0
+        self.rendered = "" # the turns above, joined, kept in sync on every add/evict
+        self.levels = [[] for _ in range(levels)] # level -> [(text, tokens)], oldest first
+        self.summary_text = ""
+        self.lock = threading.RLock()
+        self.fold_lock = threading.Lock() # one fold at a time
+
+    def add(self, actor, info):
+        line = f"{actor}:{info}\n"
+        tokens = count_tokens(line)
+        with self.lock:
+            self.turns.append((line, tokens))
+            self.rendered += line
+            self.history_tokens += tokens
+            # Shed the oldest turns (into the summary) until we're back under budget, always keeping the newest one
+            while self.history_tokens > self.history_budget and len(self.turns) > 1:
+                old_line, old_tokens = self.turns.popleft()
+                self.rendered = self.rendered[len(old_line):]
+                self.history_tokens -= old_tokens
+                self.levels[0].append((old_line.strip(), old_tokens))
+            self._render_summary()
+
+    def render(self):
+        with self.lock:
+            if self.summary_text:
+                return f"Earlier in this conversation: {self.summary_text}\n{self.rendered}"
+            return self.rendered
+
+    def _render_summary(self):
+        # Highest (oldest) level first
+        self.summary_text = " ".join(text for level in reversed(self.levels) for text, _ in level)
+
+    def _level_tokens(self, level):
+        return sum(tokens for _, tokens in self.levels[level])
+
+    def needs_fold(self):
+        with self.lock:
+            return any(self._level_tokens(level) > self.summary_budget for level in range(len(self.levels)))
+
+    def fold(self):
+        """
+        Summarizes every level that's over budget into the level above it
+        """
+        if not self.fold_lock.acquire(blocking=False):
+            return # someone's already folding
+        try:
+            self._fold_levels()
+        finally:
+            self.fold_lock.release()
+
+    def _fold_levels(self):
+        for level in range(len(self.levels)):
+            with self.lock:
+                if self._level_tokens(level) <= self.summary_budget:
+                    continue
+                entries = list(self.levels[level])
+            text = " ".join(entry for entry, _ in entries)
+            summary = self.summarizer(text, self.summary_budget // 2) if self.summarizer is not None else None
+            if not summary:
+                # No summarizer (or it failed): keep the most recent part that fits
+                summary = " ".join(truncate_to_tokens(text.replace(". ", ".\n"), self.summary_budget // 2, keep_end=True).split("\n"))
+            target = min(level + 1, len(self.levels) - 1)
+            with self.lock:
+                # Entries may have been added while we were summarizing, only replace the ones we read
+                self.levels[level] = self.levels[level][len(entries):]
+                self.levels[target].append((summary, count_tokens(summary)))
+                self._render_summary()
+
+    def fit_facts(self, facts, *fixed_parts):
+        """
+        Trims retrieved facts (one per line, best first) to whatever the prompt budget has left
+        after the summary, the recent turns and any fixed parts (e.g. the user's message)
+        """
+        with self.lock:
+            used = count_tokens(self.summary_text) + self.history_tokens
+        used += sum(count_tokens(part) for part in fixed_parts)
+        return truncate_to_tokens(facts, max(0, self.prompt_budget - used))
@@ -0,0 +1,138 @@
+from collections import defaultdict
+from groq_interface import estimate_tokens, DEFAULT_SYSTEM_PROMPT
+from rate_limit_module import PRIORITY_REPLY
+from routing_module import SPECULATIVE_PREFIX
+from prompt_module import prompts
+import asyncio
+import random
+import re
+import threading
+import time
+
+class FakeGroqAgent:
+    """
+    Drop-in, offline stand-in for Groq_Agent. Returns scripted but well-formed responses
+    (<CT>, <keys>, <new>/<fact>, <ans>, plain replies) based on the stage each call is tagged with,
+    after sleeping for a configurable latency. Counts calls and (estimated) tokens per stage.
+    Deterministic for a given seed, as long as calls arrive in the same order.
+    """
+    def __init__(self, latency=0.0, stage_latency=None, seed=0, preferred_lang="English", model="fake"):
+        self.latency = latency # seconds per call
+        self.stage_latency = stage_latency or {} # per-stage overrides
+        self.random = random.Random(seed)
+        self.lang = preferred_lang
+        self.model = model
+        self.cache = None
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.prompt_tokens = defaultdict(int)
+        self.output_tokens = defaultdict(int)
+        self.fact_counter = 0
+
+    def change_lang(self, new_lang):
+        self.lang = new_lang
+
+    def _respond(self, query, stage):
+        # Speculative calls get the same answers as the stage they run ahead of
+        if stage.startswith(SPECULATIVE_PREFIX):
+            stage = stage[len(SPECULATIVE_PREFIX):]
+        with self.lock:
+            if stage == "context_extraction":
+                return f"<CT>\nUser mentioned {self._words(query, 6)}\n<CT>"
+            if stage == "key_generation_fields":
+                fields = re.search(r"top level fields in my knowledge base:(.*)", query)
+                domains = fields.group(1).split() if fields else []
+                chosen = self.random.sample(domains, min(2, len(domains)))
+                return "<keys>\n" + "\n".join(chosen) + "\n</keys>"
+            if stage == "planner":
+                outline = re.findall(r"^\s*([^\s:]+): (.*)$", query, re.MULTILINE)
+                outline = [(domain, fields.split(",")) for domain, fields in outline if domain not in ("Context", "Newest")]
+                chosen = self.random.sample(outline, min(2, len(outline)))
+                keys = "\n".join(f"{domain} | " + ", ".join(self.random.sample(fields, min(3, len(fields)))) for domain, fields in chosen)
+                return f"<CT>\nUser mentioned {self._words(query, 6)}\n</CT>\n<keys>\n{keys}\n</keys>"
+            if stage == "key_generation_subfields":
+                lines = []
+                for domain, subfields in re.findall(r"^\s*(\S+) \| \[(.*)\]\s*$", query, re.MULTILINE):
+                    names = re.findall(r"'([^']*)'", subfields)
+                    lines.append(f"{domain} | " + ", ".join(self.random.sample(names, min(3, len(names)))))
+                return "<keys>\n" + "\n".join(lines) + "\n<\\keys>"
+            if stage == "learning" and "Knowledge base outline" in query:
+                # Batched learning: one Add per message, in the 4 column format
+                outline = re.search(r"Knowledge base outline \(domain: existing fields\):\s*\n(.*?)\n\s*\n", query, re.DOTALL)
+                domains = [line.split(":")[0].strip() for line in outline.group(1).split("\n")] if outline else []
+                messages = re.findall(r"^\s*\d+\. (.*)$", query, re.MULTILINE)
+                if not domains:
+                    return "<new>\ngeneral | Misc things about the user\n<new>"
+                self.fact_counter += 1
+                changes = [f'Add | {self.random.choice(domains)} | fact_{self.random.randint(0, 50)} | "{message}"' for message in messages]
+                return "<ans>\n" + "\n".join(changes) + "\n<ans>"
+            if stage == "learning":
+                domains = re.search(r"Top level knowledge domains:\s*\n(.*)", query)
+                domains = domains.group(1).split() if domains else []
+                if not domains:
+                    return "<new>\ngeneral | Misc things about the user\n<new>"
+                self.fact_counter += 1
+                return f"<fact>\n{self.random.choice(domains)} | Mentioned {self._words(query, 5)} (#{self.fact_counter})\n<fact>"
+            if stage == "fact_merge":
+                facts = re.search(r"The new facts we want to add:\s*\n(.*)", query, re.DOTALL)
+                facts = [f.strip() for f in facts.group(1).split("\n") if f.strip()] if facts else []
+                changes = [f'Add | fact_{self.random.randint(0, 50)} | "{fact}"' for fact in facts]
+                return "<ans>\n" + "\n".join(changes) + "\n<ans>"
+            if stage == "fact_compaction":
+                facts = re.search(r"oldest first:\s*\n(.*)", query, re.DOTALL)
+                facts = [f.strip() for f in facts.group(1).split("\n") if f.strip()] if facts else []
+                return "<SUM>\n" + "; ".join(facts[-3:]) + "\n<SUM>"
+            if stage == "context_summary":
+                return f"<SUM>\nEarlier they talked about {self._words(query, 8)}\n<SUM>"
+            if stage == "greeting" and "<G>" in query:
+                count = int(re.search(r"Write (\d+) different greetings", query).group(1))
+                return "".join(f"<G>Hey! Good to see you again ({self.random.randint(0, 99)})</G>\n" for _ in range(count))
+            if stage == "greeting":
+                return "Hey! Good to see you again."
+            return "Sounds good, tell me more about " + self._words(query, 3) + "?"
+
+    def _words(self, query, n):
+        words = re.findall(r"[A-Za-z]{4,}", query)
+        return " ".join(self.random.sample(words, min(n, len(words)))) if words else "stuff"
+
+    def _account(self, query, system_prompt, response, stage):
+        prompts.observe_prefix(self.model, system_prompt, query)
+        input_tokens = estimate_tokens(system_prompt + query)
+        output_tokens = estimate_tokens(response)
+        with self.lock:
+            self.calls[stage] += 1
+            self.prompt_tokens[stage] += input_tokens
+            self.output_tokens[stage] += output_tokens
+        return (input_tokens, response, output_tokens)
+
+    def make_query(self, query, temp = 0.8, system_prompt = DEFAULT_SYSTEM_PROMPT, priority=PRIORITY_REPLY, stage="reply"):
+        time.sleep(self.stage_latency.get(stage, self.latency))
+        return self._account(query, system_prompt, self._respond(query, stage), stage)
+
+    async def make_query_async(self, query, temp = 0.8, system_prompt = DEFAULT_SYSTEM_PROMPT, priority=PRIORITY_REPLY, stage="reply"):
+        await asyncio.sleep(self.stage_latency.get(stage, self.latency))
+        return self._account(query, system_prompt, self._respond(query, stage), stage)
+
+    def make_query_stream(self, query, temp = 0.8, system_prompt = DEFAULT_SYSTEM_PROMPT, priority=PRIORITY_REPLY, stage="reply"):
+        time.sleep(self.stage_latency.get(stage, self.latency))
+        _, response, _ = self._account(query, system_prompt, self._respond(query, stage), stage)
+        for word in response.split(" "):
+            yield word + " "
+
+    async def make_query_stream_async(self, query, temp = 0.8, system_prompt = DEFAULT_SYSTEM_PROMPT, priority=PRIORITY_REPLY, stage="reply"):
+        await asyncio.sleep(self.stage_latency.get(stage, self.latency))
+        _, response, _ = self._account(query, system_prompt, self._respond(query, stage), stage)
+        for word in response.split(" "):
+            yield word + " "
+            await asyncio.sleep(0)
+
+    def totals(self):
+        with self.lock:
+            return sum(self.calls.values()), sum(self.prompt_tokens.values())
+
+    def get_token_usage(self):
+        with self.lock:
+            return {
+                "input_tokens": sum(self.prompt_tokens.values()),
+                "output_tokens": sum(self.output_tokens.values())
+            }
@@ -1,48 +1,364 @@
-from groq import Groq
+from groq import Groq, AsyncGroq, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from rate_limit_module import RateLimiter, PRIORITY_REPLY, shared_limiter
+from metrics_module import metrics, TraceLog
+from routing_module import ModelRouter, shared_router
+from prompt_module import prompts
+import asyncio
+import httpx
+import random
+import threading
+import time
+
+DEFAULT_SYSTEM_PROMPT = "You are Ram, a helpful friend who wants the best for the current user. You prioritize honesty and giving right advice, even if it's harsh and not nice."
+
+# Worth retrying, everything else (bad request, auth...) fails straight away
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+# Connection pools shared by every agent in the process, so sessions don't each open their own connections
+POOL_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=16)
+_http_client = None
+_async_http_client = None
+_pool_lock = threading.Lock()
+
+def shared_http_client():
+    global _http_client
+    with _pool_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(limits=POOL_LIMITS, timeout=60.0)
+        return _http_client
+
+def shared_async_http_client():
+    global _async_http_client
+    with _pool_lock:
+        if _async_http_client is None:
+            _async_http_client = httpx.AsyncClient(limits=POOL_LIMITS, timeout=60.0)
+        return _async_http_client
+
+def estimate_tokens(text):
+    # Rough count (~4 chars a token) for budgeting before the provider tells us the real one
+    return len(text) // 4 + 1
+
 
 class Groq_Agent:
-    def __init__(self, groq_api_key, preferred_lang ="English", model="llama3-70b-8192", log_file = "./llm_log.txt"):
-        self.groq_client = Groq(api_key=groq_api_key)
+    def __init__(self, groq_api_key, preferred_lang ="English", model="llama3-70b-8192", log_file = "./llm_log.jsonl", cache=None,
+                 rate_limiter: RateLimiter = None, max_retries=5, base_url=None, router: ModelRouter = None):
+        # Retries are ours (with jitter and the rate limiter in the loop), so the SDK's own are turned off
+        self.groq_client = Groq(api_key=groq_api_key, base_url=base_url, http_client=shared_http_client(), max_retries=0)
+        self.async_client = None # created on first async use, it has to live on the running event loop
         self.groq_api_key = groq_api_key
-        self.model = model
+        self.base_url = base_url
+        self.model = model # default model, used by the routes that don't name their own
+        self.router = router if router is not None else shared_router() # per-stage model, temperature, max_tokens
         self.total_input_tokens = 0
         self.total_output_tokens = 0
-        self.fp = open(log_file, "a+")
+        self.trace = TraceLog.for_path(log_file) # buffered JSONL, one record per call
         self.lang = preferred_lang
+        self.lock = threading.Lock() # Several pipeline stages may query at once
+        self.cache = cache # optional ResponseCache for low temperature utility prompts
+        self.rate_limiter = rate_limiter if rate_limiter is not None else shared_limiter()
+        self.max_retries = max_retries
+        self.expected_output_tokens = 300 # budgeted per call until the real count comes back
+        self.failed_queries = 0
 
     def change_lang(self, new_lang):
         self.lang = new_lang
 
-    def make_query(self, query, temp = 0.8, system_prompt = "You are Ram, a helpful friend who wants the best for the current user. You prioritize honesty and giving right advice, even if it's harsh and not nice."):
+    def _build_messages(self, query, system_prompt, model):
+        # The static system prompt goes first and the language after it, so every request starts with the same text,
+        # then the prompt's own static instructions (see prompt_module): providers can serve that prefix from cache
+        system_prompt = system_prompt + f"\nEvery response, in its entirety, must be in {self.lang}"
+        prompts.observe_prefix(model, system_prompt, query)
+        return [{"role": "system", "content": system_prompt},
+                {"role": "user", "content": query}]
+
+    def _route(self, stage, temp):
+        choice = self.router.pick(stage, self.model)
+        temp = choice.temperature if choice.temperature is not None else temp
+        # Rate limit budget for the reply: the route's cap if it has one, a typical reply otherwise
+        expected_output = choice.max_tokens or self.expected_output_tokens
+        return choice, temp, expected_output
+
+    def _record(self, query, response_text, input_tokens, output_tokens, stage, started, choice, retryable=False, first_token=None):
+        # Update token counts, per-stage and per-route metrics and the trace
+        latency = time.perf_counter() - started
+        failed = response_text is None
+        with self.lock:
+            self.total_input_tokens += input_tokens
+            self.total_output_tokens += output_tokens
+        metrics.observe(stage, latency, input_tokens, output_tokens, failed=failed)
+        self.router.observe(choice, latency, input_tokens, output_tokens, failed, retryable, first_token)
+        self.trace.write({"ts": time.time(), "stage": stage, "model": choice.model, "latency": round(latency, 4),
+                          "input_tokens": input_tokens, "output_tokens": output_tokens, "ok": not failed,
+                          "prompt": query, "response": response_text})
+
+    def _backoff(self, attempt, error):
+        # Honour Retry-After when the provider sends one, otherwise exponential backoff with full jitter
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after is not None:
+            try:
+                delay = float(retry_after)
+                self.rate_limiter.penalize(delay)
+                return delay + random.uniform(0, 0.5)
+            except ValueError:
+                pass
+        return random.uniform(0, min(30.0, 0.5 * 2 ** attempt))
+
+    def _cache_key(self, query, temp, system_prompt, model):
+        if self.cache is None or not self.cache.cacheable(temp):
+            return None
+        return self.cache.make_key(model, self.lang, system_prompt, query, temp)
+
+    def _cached(self, query, temp, system_prompt, model):
+        cache_key = self._cache_key(query, temp, system_prompt, model)
+        if cache_key is None:
+            return None, None
+        cached = self.cache.get(cache_key)
+        metrics.count("llm_cache_hits_total" if cached is not None else "llm_cache_misses_total")
+        return cache_key, cached
+
+    def _finish(self, query, response, cache_key, est_tokens, stage, started, choice):
+        self.rate_limiter.settle(est_tokens, response.usage.total_tokens)
+        self._record(query, response.choices[0].message.content, response.usage.prompt_tokens, response.usage.completion_tokens, stage, started, choice)
+        result = (response.usage.prompt_tokens, response.choices[0].message.content, response.usage.completion_tokens)
+        if cache_key is not None:
+            self.cache.put(cache_key, result)
+        return result
+
+    def _failed(self, e, query, est_tokens, stage, started, choice):
+        print(f"Error making Groq query: {str(e)}")
+        # Nothing was used, hand back what the last attempt reserved
+        self.rate_limiter.settle(est_tokens, 0)
+        with self.lock:
+            self.failed_queries += 1
+        self._record(query, None, 0, 0, stage, started, choice, retryable=isinstance(e, RETRYABLE_ERRORS))
+        # If possible, find a better alternative than just setting input prompt tokens to 0
+        return (0 , None, 0)
+
+    def _next_attempt(self, attempt, error, est_tokens, stage, temp, choice):
+        """
+        After a retryable error: None once the retries are used up (the caller gives up, which settles the reservation).
+        Otherwise hands back the failed attempt's reservation (every attempt reserves the estimate again),
+        lets the router switch a failing primary over to its fallback, and returns (choice, temp, seconds to wait)
+        for the next attempt
+        """
+        if attempt == self.max_retries:
+            return None
+        self.rate_limiter.settle(est_tokens, 0)
+        self.router.note_error(choice)
+        choice, temp, _ = self._route(stage, temp)
+        return choice, temp, self._backoff(attempt, error)
+
+    def make_query(self, query, temp = 0.8, system_prompt = DEFAULT_SYSTEM_PROMPT, priority=PRIORITY_REPLY, stage="reply"):
         """
         Makes a query to the Groq API and returns the (num_input_tokens, response text, num_output_tokens)
-        Also tracks token usage.
+        Also tracks token usage. Waits for rate limit budget (background priority waits longer)
+        and retries on rate limits and transient errors. Returns (0, None, 0) if it still fails.
+        stage tags the call in metrics and the trace, and picks its route (model, temperature, max_tokens).
+        A retryable error on a route's primary model switches the retries over to its fallback.
+        """
+        choice, temp, expected_output = self._route(stage, temp)
+        cache_key, cached = self._cached(query, temp, system_prompt, choice.model)
+        if cached is not None:
+            return cached
+        messages = self._build_messages(query, system_prompt, choice.model)
+        est_tokens = estimate_tokens(messages[0]["content"] + query) + expected_output
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(est_tokens, priority)
+            try:
+                response = self.groq_client.chat.completions.create(
+                    messages=messages,
+                    model=choice.model,
+                    temperature=temp,
+                    max_tokens=choice.max_tokens
+                )
+                return self._finish(query, response, cache_key, est_tokens, stage, started, choice)
+            except RETRYABLE_ERRORS as e:
+                retry = self._next_attempt(attempt, e, est_tokens, stage, temp, choice)
+                if retry is None:
+                    return self._failed(e, query, est_tokens, stage, started, choice)
+                choice, temp, delay = retry
+                # The answer is cached under the model that actually gave it
+                cache_key = self._cache_key(query, temp, system_prompt, choice.model)
+                time.sleep(delay)
+            except Exception as e:
+                return self._failed(e, query, est_tokens, stage, started, choice)
+
+    async def make_query_async(self, query, temp = 0.8, system_prompt = DEFAULT_SYSTEM_PROMPT, priority=PRIORITY_REPLY, stage="reply"):
+        """
+        Async version of make_query, shares the connection pool, rate limiter, routes and retry policy
+        """
+        choice, temp, expected_output = self._route(stage, temp)
+        cache_key, cached = self._cached(query, temp, system_prompt, choice.model)
+        if cached is not None:
+            return cached
+        self._ensure_async_client()
+        messages = self._build_messages(query, system_prompt, choice.model)
+        est_tokens = estimate_tokens(messages[0]["content"] + query) + expected_output
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire_async(est_tokens, priority)
+            try:
+                response = await self.async_client.chat.completions.create(
+                    messages=messages,
+                    model=choice.model,
+                    temperature=temp,
+                    max_tokens=choice.max_tokens
+                )
+                return self._finish(query, response, cache_key, est_tokens, stage, started, choice)
+            except RETRYABLE_ERRORS as e:
+                retry = self._next_attempt(attempt, e, est_tokens, stage, temp, choice)
+                if retry is None:
+                    return self._failed(e, query, est_tokens, stage, started, choice)
+                choice, temp, delay = retry
+                cache_key = self._cache_key(query, temp, system_prompt, choice.model)
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                # The request was cancelled (timeout, client gone), that says nothing about the model
+                metrics.count("llm_cancelled_total")
+                self.rate_limiter.settle(est_tokens, 0)
+                raise
+            except Exception as e:
+                return self._failed(e, query, est_tokens, stage, started, choice)
+
+    def _ensure_async_client(self):
+        if self.async_client is None:
+            self.async_client = AsyncGroq(api_key=self.groq_api_key, base_url=self.base_url,
+                                          http_client=shared_async_http_client(), max_retries=0)
+
+    def make_query_stream(self, query, temp = 0.8, system_prompt = DEFAULT_SYSTEM_PROMPT, priority=PRIORITY_REPLY, stage="reply"):
+        """
+        Same as make_query, but yields the response text chunk by chunk as it's generated.
+        Token usage and the log are updated once the stream is over.
+        Only the initial request is retried, a stream that breaks halfway is not.
+        """
+        pieces = []
+        input_tokens, output_tokens = 0, 0
+        failed = False
+        retryable = False
+        first_token = None
+        choice, temp, expected_output = self._route(stage, temp)
+        messages = self._build_messages(query, system_prompt, choice.model)
+        est_tokens = estimate_tokens(messages[0]["content"] + query) + expected_output
+        started = time.perf_counter()
+        try:
+            stream = None
+            for attempt in range(self.max_retries + 1):
+                self.rate_limiter.acquire(est_tokens, priority)
+                try:
+                    stream = self.groq_client.chat.completions.create(
+                        messages=messages,
+                        model=choice.model,
+                        temperature=temp,
+                        max_tokens=choice.max_tokens,
+                        stream=True
+                    )
+                    break
+                except RETRYABLE_ERRORS as e:
+                    retry = self._next_attempt(attempt, e, est_tokens, stage, temp, choice)
+                    if retry is None:
+                        raise
+                    choice, temp, delay = retry
+                    time.sleep(delay)
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                    pieces.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+                # Groq only reports usage on the last chunk
+                x_groq = getattr(chunk, "x_groq", None)
+                if x_groq is not None and getattr(x_groq, "usage", None) is not None:
+                    input_tokens = x_groq.usage.prompt_tokens
+                    output_tokens = x_groq.usage.completion_tokens
+
+        except Exception as e:
+            print(f"Error making Groq streaming query: {str(e)}")
+            failed = True
+            retryable = isinstance(e, RETRYABLE_ERRORS)
+            with self.lock:
+                self.failed_queries += 1
+        finally:
+            # Runs even if the consumer stops early (e.g. the client disconnected)
+            self.rate_limiter.settle(est_tokens, input_tokens + output_tokens)
+            self._record(query, None if failed else "".join(pieces), input_tokens, output_tokens, stage, started, choice,
+                         retryable, first_token)
+
+    async def make_query_stream_async(self, query, temp = 0.8, system_prompt = DEFAULT_SYSTEM_PROMPT, priority=PRIORITY_REPLY, stage="reply"):
+        """
+        Async version of make_query_stream. Cancelling the consumer closes the upstream stream.
         """
-        system_prompt = f"Every response, in its entirety, must be in {self.lang}\n" + system_prompt
+        pieces = []
+        input_tokens, output_tokens = 0, 0
+        failed = False
+        retryable = False
+        first_token = None
+        cancelled = False
+        choice, temp, expected_output = self._route(stage, temp)
+        self._ensure_async_client()
+        messages = self._build_messages(query, system_prompt, choice.model)
+        est_tokens = estimate_tokens(messages[0]["content"] + query) + expected_output
+        started = time.perf_counter()
+        stream = None
         try:
-            response = self.groq_client.chat.completions.create(
-                messages=[{"role": "system", "content": system_prompt},
-                    {"role": "user", "content": query}],
-                model=self.model,
-                temperature=temp
-            )
-            
-            # Update token counts
-            self.total_input_tokens += response.usage.prompt_tokens
-            self.total_output_tokens += response.usage.completion_tokens
-            self.fp.write(f"prompt:{query}\n\n LLM response:{response.choices[0].message.content}")
-            return (response.usage.prompt_tokens, response.choices[0].message.content, response.usage.completion_tokens)
+            for attempt in range(self.max_retries + 1):
+                await self.rate_limiter.acquire_async(est_tokens, priority)
+                try:
+                    stream = await self.async_client.chat.completions.create(
+                        messages=messages,
+                        model=choice.model,
+                        temperature=temp,
+                        max_tokens=choice.max_tokens,
+                        stream=True
+                    )
+                    break
+                except RETRYABLE_ERRORS as e:
+                    retry = self._next_attempt(attempt, e, est_tokens, stage, temp, choice)
+                    if retry is None:
+                        raise
+                    choice, temp, delay = retry
+                    await asyncio.sleep(delay)
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                    pieces.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+                x_groq = getattr(chunk, "x_groq", None)
+                if x_groq is not None and getattr(x_groq, "usage", None) is not None:
+                    input_tokens = x_groq.usage.prompt_tokens
+                    output_tokens = x_groq.usage.completion_tokens
 
+        except (asyncio.CancelledError, GeneratorExit):
+            cancelled = True
+            metrics.count("llm_cancelled_total")
+            raise
         except Exception as e:
-            print(f"Error making Groq query: {str(e)}")
-            # If possible, find a better alternative than just setting input prompt tokens to 0
-            return (0 , None, 0)
+            print(f"Error making Groq streaming query: {str(e)}")
+            failed = True
+            retryable = isinstance(e, RETRYABLE_ERRORS)
+            with self.lock:
+                self.failed_queries += 1
+        finally:
+            if stream is not None and (cancelled or failed):
+                await stream.close()
+            self.rate_limiter.settle(est_tokens, input_tokens + output_tokens)
+            if not cancelled:
+                self._record(query, None if failed else "".join(pieces), input_tokens, output_tokens, stage, started, choice,
+                             retryable, first_token)
 
     def get_token_usage(self):
         """
         Returns the current token usage statistics
         """
-        return {
+        usage = {
             "input_tokens": self.total_input_tokens,
-            "output_tokens": self.total_output_tokens
-        }
\ No newline at end of file
+            "output_tokens": self.total_output_tokens,
+            "failed_queries": self.failed_queries,
+            "routes": self.router.stats(),
+            "prompts": prompts.stats()
+        }
+        if self.cache is not None:
+            usage.update(self.cache.stats())
+        return usage
@@ -0,0 +1,122 @@
+from collections import Counter, defaultdict
+import math
+import re
+
+# Optional: local CPU embeddings to re-rank the lexical hits
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+STOP_WORDS = {
+    "a", "an", "the", "and", "or", "but", "is", "are", "was", "were", "be", "been", "to", "of", "in",
+    "on", "at", "for", "with", "about", "as", "by", "it", "its", "this", "that", "i", "you", "he", "she",
+    "we", "they", "me", "my", "your", "his", "her", "our", "their", "so", "do", "did", "does", "have",
+    "has", "had", "not", "no", "what", "how", "just", "if", "then", "up", "out", "from", "am", "im",
+}
+
+def tokenize(text):
+    return [tok for tok in re.findall(r"[a-z0-9]+", text.lower()) if tok not in STOP_WORDS]
+
+
+class FactIndex:
+    """
+    In-process BM25 index over every data[domain][field] fact in the KB.
+    Documents are keyed by (domain, field) and can be added/replaced/removed one at a time,
+    so Memory can keep it in sync without ever rebuilding it.
+    """
+    def __init__(self, k1=1.5, b=0.75, use_embeddings=False, embedding_model="all-MiniLM-L6-v2"):
+        self.k1 = k1
+        self.b = b
+        self.doc_terms = {} # (domain, field) -> Counter of terms
+        self.doc_lens = {}
+        self.doc_freq = Counter() # term -> number of docs containing it
+        self.postings = defaultdict(set) # term -> set of (domain, field)
+        self.total_len = 0
+
+        self.embedder = None
+        self.doc_vectors = {}
+        if use_embeddings:
+            if SentenceTransformer is None:
+                print("sentence-transformers isn't installed, falling back to lexical retrieval only")
+            else:
+                self.embedder = SentenceTransformer(embedding_model, device="cpu")
+
+    def __len__(self):
+        return len(self.doc_terms)
+
+    def build(self, data):
+        for domain, fields in data.items():
+            self.build_domain(domain, fields)
+
+    def build_domain(self, domain, fields):
+        for field, fact in fields.items():
+            self.update(domain, field, fact)
+
+    def remove_domain(self, domain, fields):
+        for field in fields:
+            self.remove(domain, field)
+
+    def update(self, domain, field, fact):
+        key = (domain, field)
+        self.remove(domain, field)
+        if not isinstance(fact, str) or fact.strip() == "":
+            return
+        # Field and domain names are usually the most telling words, so they're indexed too
+        terms = Counter(tokenize(f"{domain} {field.replace('_', ' ')} {fact}"))
+        self.doc_terms[key] = terms
+        self.doc_lens[key] = sum(terms.values())
+        self.total_len += self.doc_lens[key]
+        for term in terms:
+            self.doc_freq[term] += 1
+            self.postings[term].add(key)
+        if self.embedder is not None:
+            self.doc_vectors[key] = self.embedder.encode(f"{field}: {fact}", normalize_embeddings=True)
+
+    def remove(self, domain, field):
+        key = (domain, field)
+        terms = self.doc_terms.pop(key, None)
+        if terms is None:
+            return
+        self.total_len -= self.doc_lens.pop(key)
+        for term in terms:
+            self.doc_freq[term] -= 1
+            self.postings[term].discard(key)
+            if self.doc_freq[term] <= 0:
+                del self.doc_freq[term]
+                del self.postings[term]
+        self.doc_vectors.pop(key, None)
+
+    def search(self, query, top_k=8, min_score=0.0):
+        """
+        Returns [((domain, field), score), ...] best first
+        """
+        num_docs = len(self.doc_terms)
+        if num_docs == 0:
+            return []
+        avg_len = self.total_len / num_docs
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            idf = math.log(1 + (num_docs - self.doc_freq[term] + 0.5) / (self.doc_freq[term] + 0.5))
+            for key in self.postings[term]:
+                tf = self.doc_terms[key][term]
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lens[key] / avg_len)
+                scores[key] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        ranked = [(key, score) for key, score in ranked if score > min_score]
+        if self.embedder is not None and ranked:
+            ranked = self._rerank(query, ranked[:top_k * 4])
+        return ranked[:top_k]
+
+    def _rerank(self, query, candidates):
+        # Blend the lexical score with cosine similarity, lexical scores are scaled to [0, 1] first
+        query_vector = self.embedder.encode(query, normalize_embeddings=True)
+        best = candidates[0][1]
+        blended = []
+        for key, score in candidates:
+            similarity = float(query_vector @ self.doc_vectors[key]) if key in self.doc_vectors else 0.0
+            blended.append((key, 0.5 * score / best + 0.5 * similarity))
+        return sorted(blended, key=lambda item: item[1], reverse=True)
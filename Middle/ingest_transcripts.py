@@ -0,0 +1,186 @@
+"""
+Bulk-learns a user's KB from past conversations, instead of one /chat turn at a time.
+    python ingest_transcripts.py history.jsonl --kb KB/users/alice/permanent.json --workers 4
+Input is JSONL, one message per line. The text is taken from "message", "text", "content" or "body"
+(with "title" in front, if there is one), the conversation from "conversation_id", "convo_id" or "session_id",
+and "role" (or "actor") marks assistant lines, which are used as context but not learned from.
+Consecutive messages are learned in batches (Learner.propose_batch), several batches in flight at once,
+while the changes are applied to Memory one batch at a time, in input order. Progress is checkpointed
+after every applied batch, so running the same command again resumes where it stopped.
+If a learning call still fails after its retries, the run stops before that batch, and the next one retries it.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from retrieval_module import Memory
+from learning_module import Learner, LearningFailed, is_small_talk
+from compaction_module import FactCompactor
+import argparse
+import json
+import os
+import sys
+import time
+
+TEXT_KEYS = ("message", "text", "content", "body")
+CONVO_KEYS = ("conversation_id", "convo_id", "session_id")
+BOT_ROLES = {"assistant", "bot", "system", "ram"}
+
+def read_messages(path, start_line=0):
+    """
+    Yields (line number, conversation id, is_user, text) for every usable line after start_line
+    """
+    with open(path, "r") as file:
+        for line_no, line in enumerate(file, start=1):
+            if line_no <= start_line or line.strip() == "":
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping line {line_no}: not valid JSON")
+                continue
+            text = next((record[key] for key in TEXT_KEYS if isinstance(record.get(key), str)), None)
+            if text is None:
+                continue
+            if isinstance(record.get("title"), str):
+                text = f"{record['title']}. {text}"
+            convo = next((str(record[key]) for key in CONVO_KEYS if key in record), None)
+            role = str(record.get("role", record.get("actor", "user"))).lower()
+            yield line_no, convo, role not in BOT_ROLES, text.strip()
+
+def make_batches(messages, batch_size, context_lines=6):
+    """
+    Groups user messages into batches of batch_size: yields (last line number, [(conversation so far, message)]).
+    A batch never spans two conversations, so the context of every message is its own conversation.
+    """
+    batch, last_line, current_convo = [], 0, None
+    recent = deque(maxlen=context_lines)
+    for line_no, convo, is_user, text in messages:
+        if convo != current_convo:
+            if batch:
+                yield last_line, batch
+                batch = []
+            recent.clear()
+            current_convo = convo
+        recent.append(f"{'User' if is_user else 'Bot'}:{text}")
+        last_line = line_no
+        if not is_user or is_small_talk(text):
+            continue
+        batch.append(("\n".join(recent), text))
+        if len(batch) >= batch_size:
+            yield last_line, batch
+            batch = []
+    if batch:
+        yield last_line, batch
+
+
+class Checkpoint:
+    """
+    Input lines fully applied to the KB so far, plus running totals. Written atomically after every batch.
+    """
+    def __init__(self, path, input_path):
+        self.path = path
+        self.state = {"input": os.path.abspath(input_path), "lines_done": 0, "messages": 0, "batches": 0, "seconds": 0.0}
+        self.messages_this_run = 0
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                saved = json.load(file)
+            if saved.get("input") != self.state["input"]:
+                raise ValueError(f"{path} belongs to {saved.get('input')}, not {input_path}")
+            self.state.update(saved)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.state, file)
+        os.replace(tmp_path, self.path)
+
+
+def report(checkpoint, llm, started, prefix=""):
+    # Totals include earlier (interrupted) runs, the rate is for this one
+    state = checkpoint.state
+    elapsed = time.perf_counter() - started
+    usage = llm.get_token_usage()
+    print(f"{prefix}{state['messages']} messages in {state['batches']} batches, up to line {state['lines_done']} | "
+          f"{checkpoint.messages_this_run / elapsed if elapsed > 0 else 0:.1f} msg/s, "
+          f"{usage['input_tokens'] + usage['output_tokens']} tokens this run")
+
+def ingest(path, memory: Memory, learner: Learner, llm, workers=4, batch_size=8, checkpoint_path=None, report_every=10):
+    checkpoint = Checkpoint(checkpoint_path or path + ".checkpoint.json", path)
+    started = time.perf_counter()
+    last_save = started
+
+    def propose(batch):
+        # Worker side: retrieval is local, only the learning call goes out to the LLM
+        turns = [(context, memory.retrieve(message), message) for context, message in batch]
+        return learner.propose_batch(turns)
+
+    def apply_oldest(in_flight):
+        # Writer side: one batch at a time, in input order, then persist and move the checkpoint.
+        # A failed batch raises LearningFailed before the checkpoint moves past it
+        nonlocal last_save
+        last_line, size, future = in_flight[0]
+        proposal = future.result()
+        in_flight.popleft()
+        learner.apply_batch(proposal)
+        memory.write_to_disk()
+        state = checkpoint.state
+        state["lines_done"] = last_line
+        state["messages"] += size
+        state["batches"] += 1
+        now = time.perf_counter()
+        state["seconds"] += now - last_save # time spent over all runs, for the overall rate
+        last_save = now
+        checkpoint.messages_this_run += size
+        checkpoint.save()
+        if report_every and state["batches"] % report_every == 0:
+            report(checkpoint, llm, started, prefix="  ")
+
+    in_flight = deque() # (last line, number of messages, future), oldest first
+    messages = read_messages(path, start_line=checkpoint.state["lines_done"])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            # Keep a couple of batches queued per worker, not the whole file
+            for last_line, batch in make_batches(messages, batch_size):
+                in_flight.append((last_line, len(batch), pool.submit(propose, batch)))
+                while len(in_flight) >= workers * 2:
+                    apply_oldest(in_flight)
+            while in_flight:
+                apply_oldest(in_flight)
+        except LearningFailed:
+            # Later batches would be learned out of order, drop them, the next run does them again
+            pool.shutdown(cancel_futures=True)
+            raise
+    return checkpoint, started
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Learn a KB from past conversations in a JSONL file")
+    parser.add_argument("path", help="JSONL file with one message per line")
+    parser.add_argument("--kb", default="KB/permanent.json", help="KB to learn into")
+    parser.add_argument("--workers", type=int, default=4, help="learning calls in flight at once")
+    parser.add_argument("--batch-size", type=int, default=8, help="messages per learning call")
+    parser.add_argument("--checkpoint", help="checkpoint file, defaults to <path>.checkpoint.json")
+    parser.add_argument("--compact", action="store_true", help="compact oversized fields once everything is learned")
+    parser.add_argument("--fake", type=float, metavar="LATENCY", help="use the offline fake LLM (with this latency) for a dry run")
+    args = parser.parse_args()
+
+    if args.fake is not None:
+        from fake_llm import FakeGroqAgent
+        llm = FakeGroqAgent(latency=args.fake)
+    else:
+        from groq_interface import Groq_Agent
+        load_dotenv()
+        llm = Groq_Agent(os.getenv("GROQ_API_KEY"))
+    memory = Memory(llm, path_to_permanent_data=args.kb, retrieval_mode="index")
+    llm.change_lang(memory.get_basic_info("preferred_lang") or "English")
+
+    try:
+        checkpoint, started = ingest(args.path, memory, Learner(memory, llm), llm, args.workers, args.batch_size, args.checkpoint)
+    except LearningFailed as e:
+        print(f"Stopped: {e}. Run the same command again to resume from the last checkpoint.")
+        sys.exit(1)
+    if args.compact:
+        compactor = FactCompactor(memory, llm, min_idle_seconds=0, per_run=args.workers * 4)
+        while compactor.run():
+            memory.write_to_disk()
+    memory.write_to_disk()
+    report(checkpoint, llm, started, prefix="Done: ")
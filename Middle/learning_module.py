@@ -1,7 +1,19 @@
 from retrieval_module import Memory
 from typing import List
 from groq_interface import Groq_Agent
+from rate_limit_module import PRIORITY_BACKGROUND
+from index_module import tokenize
+from prompt_module import prompts
 import re
+import queue
+import threading
+
+
+class LearningFailed(Exception):
+    """
+    The learning call failed even after retries. Unlike an empty proposal, the batch still has to be learned
+    """
+
 
 class Learner:
     def __init__(self, memory_module: Memory, llm_interface:Groq_Agent):
@@ -15,37 +27,12 @@ class Learner:
     def learn_from_query(self, query, retrieved_context):
         # query: user's last interaction + context summary till now
         # retrieved context: Stuff we already know about this query
-        learning_prompt = f"""
-            The user's last query and the conversation so far: 
-            {query}
-
-            Top level knowledge domains:
-            {" ".join(self.mem.top_level_fields)}
-
-            Retrieved context, stuff we ALREADY KNOW (only for reference, not to be learned from):
-            {retrieved_context}
-            
-            1. Figure out what, if any, information is contained in the user's query that is not there in the context
-                in other words, we want to learn <info in query> - <info retrieved>
-            2. Learn only significant facts
-            Also, figure out if we need NEW top level domains i.e. NOT in those listed above
-            Your entire output should be in this format, and contain nothing else
-            ""
-            <new>
-            ...(new, single-word, top level domain) | (general info. about this domain)
-            e.g. "health | Ishaan reports being in good health"
-            <new>
-            \n\n
-            <fact>
-            ...(New facts and which top level domain they come under)
-            (e.g. "<existing(/newly added)_top_level_domain> |His sister's name is <>")
-            <fact>
-            ""
-            Do not return <new>...<new> and <fact>...<fact> tags, if they're empty
-            BE VERY, VERY CONCISE AND PRECISE. No text outside tags. 
-            Store the facts in a personal tone
-        """
-        (_, resp, _) = self.llm.make_query(learning_prompt, temp=0.5)
+        learning_prompt = prompts.render("learning", domains=" ".join(self.mem.top_level_fields), retrieved=retrieved_context, query=query)
+        # Learning is never what the user is waiting on, so it goes in the background lane
+        (_, resp, _) = self.llm.make_query(learning_prompt, temp=0.5, priority=PRIORITY_BACKGROUND, stage="learning")
+        if resp is None:
+            # Query failed even after retries, nothing to learn from this turn
+            return
         # Add necessary new top level domains
         new_domain_matches_rough = re.search(r"<new>(.*?)<new>", resp, re.DOTALL)
         if new_domain_matches_rough is not None:
@@ -75,32 +62,219 @@ class Learner:
                 domain_fact[domain.strip()] = []
             domain_fact[domain.strip()].append(factoid)
         # now, go top level domain by domain, and add/alter it 
+        last_learned = None
         for top_level_domain, new_facts_list in domain_fact.items():
             if top_level_domain not in self.mem.field_data:
                 continue
-            existing_fields = list(self.mem.data[top_level_domain].keys())
-            prompt = f"""
-            Here are the existing fields of this domain:
-            {", ".join(existing_fields)}
-            The new facts we want to add:
-            {"\n".join(new_facts_list)}
-            Please, for each change you're SURE you want to make to this domain's data, return an item:
-            <Add/Alter> |<single-word new/existing field_name>| "<fact_string>"
-            Return all output within <ans>.. <ans> tags, NO EXTRA TEXT
-            e.g. 
-            <ans>
-            Add | sister | "Aadya, 5 years younger",
-            Alter | motivation | "After experiencing travel and parties, earning money has become a bigger motivation for Ishaan"
-            <ans>
-            This example will associate "sister" key with "Aadya, 5 years younger"
-            Also, don't assume any context, like write "that day" for "today"
-            """
-            (_, resp, _) = self.llm.make_query(prompt, temp=0.1)
-            changes = re.search(r"<ans>(.*?)<ans>", resp, re.DOTALL).group(1).strip().split("\n") # List of changes
+            existing_fields = self.mem.field_names(top_level_domain)
+            prompt = prompts.render("fact_merge", fields=", ".join(existing_fields), facts="\n".join(new_facts_list))
+            (_, resp, _) = self.llm.make_query(prompt, temp=0.1, priority=PRIORITY_BACKGROUND, stage="fact_merge")
+            changes_match = re.search(r"<ans>(.*?)<ans>", resp, re.DOTALL) if resp is not None else None
+            if changes_match is None:
+                continue
+            changes = changes_match.group(1).strip().split("\n") # List of changes
             for change in changes:
                 x, field, fact_string = list(map(lambda x:x.strip(), change.split("|")))
                 self.mem.change_subfield_and_fact(top_level_domain, field, fact_string, (x.strip().lower()=="add"))
+                last_learned = f"Last learned fact: {field}: {fact_string}"
 
         # Return the last learned fact(to keep track of the next convo)
-        return f"Last learned fact: {field}: {fact_string}"
-            
+        return last_learned
+
+    def _batch_outline(self, retrieved_lines):
+        # All domain names, plus the field names of the domains this batch touched (from what was retrieved)
+        touched = {line.split(":", 1)[0] for line in retrieved_lines if ":" in line}
+        with self.mem.lock:
+            outline = []
+            for domain in self.mem.top_level_fields:
+                if domain in touched:
+                    outline.append(f"{domain}: {', '.join(self.mem.field_names(domain)[:40])}")
+                else:
+                    outline.append(domain)
+        return "\n".join(outline)
+
+    def learn_batch(self, turns):
+        """
+        Learns from several turns in one structured call, instead of 1 + 1 per domain calls per turn.
+        turns: [(query, retrieved_context, user_message), ...] oldest first
+        Changes inside the batch are de-duplicated (later ones supersede earlier ones) before touching memory.
+        """
+        try:
+            proposal = self.propose_batch(turns)
+        except LearningFailed:
+            # Same as learn_from_query, nothing to learn from these turns
+            return None
+        return self.apply_batch(proposal)
+
+    def propose_batch(self, turns):
+        """
+        The LLM half of learn_batch: returns the changes it would make, without touching memory.
+        (new_domains, {(domain, field): [is_add, [facts]]}), or None if there's nothing to learn.
+        Raises LearningFailed if the LLM call failed.
+        Safe to run for several batches at once, as long as apply_batch calls are serialized.
+        """
+        if not turns:
+            return None
+        messages = "\n".join(f"{i + 1}. {user_message}" for i, (_, _, user_message) in enumerate(turns))
+        retrieved_lines = list(dict.fromkeys(line for (_, retrieved, _) in turns for line in retrieved.split("\n") if line.strip()))
+        retrieved = "\n".join(retrieved_lines)
+        outline = self._batch_outline(retrieved_lines)
+        latest_context = turns[-1][0]
+        prompt = prompts.render("learning_batch", outline=outline, retrieved=retrieved, context=latest_context, messages=messages)
+        (_, resp, _) = self.llm.make_query(prompt, temp=0.1, priority=PRIORITY_BACKGROUND, stage="learning")
+        if resp is None:
+            raise LearningFailed(f"learning call failed for a batch of {len(turns)} messages")
+
+        new_domains = []
+        new_domain_matches = re.search(r"<new>(.*?)<new>", resp, re.DOTALL)
+        if new_domain_matches is not None:
+            for line in new_domain_matches.group(1).strip().split("\n"):
+                if line.strip() == "":
+                    continue
+                domain_name, _, g_string = line.partition("|")
+                new_domains.append((domain_name.strip(), g_string.strip()))
+        known_domains = {domain for domain, _ in new_domains}
+
+        changes_match = re.search(r"<ans>(.*?)<ans>", resp, re.DOTALL)
+        if changes_match is None:
+            return (new_domains, {}) if new_domains else None
+        # (domain, field) -> [is_add, [facts]]; an Alter supersedes everything before it, Adds pile up without repeats
+        merged = {}
+        for change in changes_match.group(1).strip().split("\n"):
+            parts = [part.strip() for part in change.split("|")]
+            if len(parts) != 4:
+                continue
+            action, domain, field, fact_string = parts
+            fact_string = fact_string.strip('",').strip()
+            if (domain not in self.mem.field_data and domain not in known_domains) or field == "" or fact_string == "":
+                continue
+            key = (domain, field)
+            if action.lower() == "alter" or key not in merged:
+                merged[key] = [action.lower() == "add", [fact_string]]
+            elif fact_string.lower() not in (fact.lower() for fact in merged[key][1]):
+                merged[key][1].append(fact_string)
+        return new_domains, merged
+
+    def apply_batch(self, proposal):
+        """
+        The memory half of learn_batch. Returns the last learned fact, or None
+        """
+        if proposal is None:
+            return None
+        new_domains, merged = proposal
+        self._add_new_top_level_domains(new_domains)
+        last_learned = None
+        for (domain, field), (is_add, facts) in merged.items():
+            fact_string = "; ".join(facts)
+            self.mem.change_subfield_and_fact(domain, field, fact_string, is_add)
+            last_learned = f"Last learned fact: {field}: {fact_string}"
+        return last_learned
+
+SMALL_TALK_WORDS = {"hi", "hey", "hello", "yo", "sup", "ok", "okay", "lol", "haha", "thanks", "thank", "bye",
+                    "cool", "nice", "yeah", "yes", "yep", "nope", "hmm", "s", "t", "good", "morning", "night"}
+
+def is_small_talk(message):
+    # "hi", "lol ok", "thanks!" etc. have nothing worth learning. Anything else, even one word ("Berlin" as an answer
+    # to where the user lives), goes to the learning call, which decides for itself
+    return all(word in SMALL_TALK_WORDS for word in tokenize(message))
+
+class LearningQueue:
+    """
+    Runs learning jobs on a single background thread, strictly in the order they were submitted.
+    One worker means KB writes from consecutive turns never interleave.
+    Other background jobs that write to memory (e.g. end of convo) can be queued behind learning with submit_job.
+    With batch_size set, turns are buffered and learned together (Learner.learn_batch) every batch_size turns,
+    after idle_seconds without a new turn, or on flush() (end of the convo). Small talk is skipped.
+    """
+    def __init__(self, learner: Learner, on_learned=None, batch_size=None, idle_seconds=60.0):
+        self.learner = learner
+        self.on_learned = on_learned # called after every job, e.g. to persist memory
+        self.last_learned_thing = None
+        self.batch_size = batch_size # None: learn every turn on its own
+        self.idle_seconds = idle_seconds
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.idle_timer = None
+        self.jobs = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, query, retrieved_context, user_message=None):
+        if self.batch_size is None:
+            self.jobs.put(("turn", (query, retrieved_context)))
+            return
+        user_message = user_message if user_message is not None else query
+        if is_small_talk(user_message):
+            return
+        with self.buffer_lock:
+            self.buffer.append((query, retrieved_context, user_message))
+            if len(self.buffer) >= self.batch_size:
+                self._enqueue_batch()
+            else:
+                self._restart_idle_timer()
+
+    def submit_job(self, job):
+        """
+        Runs job() on the worker, after everything submitted so far (including a half-full batch)
+        """
+        with self.buffer_lock:
+            self._enqueue_batch()
+            self.jobs.put(("call", job))
+
+    def _restart_idle_timer(self):
+        # Called with buffer_lock held
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        self.idle_timer = threading.Timer(self.idle_seconds, self._flush_buffer)
+        self.idle_timer.daemon = True
+        self.idle_timer.start()
+
+    def _enqueue_batch(self):
+        # Called with buffer_lock held
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        if self.buffer:
+            self.jobs.put(("batch", self.buffer))
+            self.buffer = []
+
+    def _flush_buffer(self):
+        with self.buffer_lock:
+            self._enqueue_batch()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                kind, payload = job
+                if kind == "call":
+                    learned = payload()
+                elif kind == "batch":
+                    learned = self.learner.learn_batch(payload)
+                else:
+                    learned = self.learner.learn_from_query(*payload)
+                if learned is not None:
+                    self.last_learned_thing = learned
+                if self.on_learned is not None:
+                    self.on_learned()
+            except Exception as e:
+                # A bad LLM response shouldn't kill the worker for the rest of the convo
+                print(f"Error while learning: {str(e)}")
+            finally:
+                self.jobs.task_done()
+
+    def flush(self, wait=True):
+        """
+        Blocks until everything submitted so far has been learned, including a half-full batch.
+        wait=False only queues the half-full batch
+        """
+        self._flush_buffer()
+        if wait:
+            self.jobs.join()
+
+    def stop(self):
+        self.flush()
+        self.jobs.put(None)
+        self.worker.join()
@@ -0,0 +1,135 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import atexit
+import json
+import threading
+import time
+
+# Latency buckets (seconds), LLM calls range from ~100ms to tens of seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Per-stage latency histograms plus token, call and failure counters.
+    Stages are free-form names: LLM calls are tagged by what they're for (context_extraction, reply, ...),
+    non-LLM work (retrieval, disk_write) is timed with stage().
+    """
+    def __init__(self, prefix="him"):
+        self.prefix = prefix
+        self.latency = defaultdict(Histogram)
+        self.calls = defaultdict(int)
+        self.failures = defaultdict(int)
+        self.input_tokens = defaultdict(int)
+        self.output_tokens = defaultdict(int)
+        self.counters = defaultdict(int) # anything else worth counting, e.g. cache hits
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds, input_tokens=0, output_tokens=0, failed=False):
+        with self.lock:
+            self.latency[stage].observe(seconds)
+            self.calls[stage] += 1
+            self.input_tokens[stage] += input_tokens
+            self.output_tokens[stage] += output_tokens
+            if failed:
+                self.failures[stage] += 1
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, failed=failed)
+
+    def render(self):
+        """
+        Prometheus text exposition format
+        """
+        p = self.prefix
+        lines = []
+        with self.lock:
+            lines.append(f"# TYPE {p}_stage_latency_seconds histogram")
+            for stage, hist in sorted(self.latency.items()):
+                for bound, count in zip(hist.buckets, hist.counts):
+                    lines.append(f'{p}_stage_latency_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{p}_stage_latency_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist.count}')
+                lines.append(f'{p}_stage_latency_seconds_sum{{stage="{stage}"}} {hist.total}')
+                lines.append(f'{p}_stage_latency_seconds_count{{stage="{stage}"}} {hist.count}')
+            for name, values in (("stage_calls_total", self.calls), ("stage_failures_total", self.failures),
+                                 ("stage_input_tokens_total", self.input_tokens), ("stage_output_tokens_total", self.output_tokens)):
+                lines.append(f"# TYPE {p}_{name} counter")
+                for stage, value in sorted(values.items()):
+                    lines.append(f'{p}_{name}{{stage="{stage}"}} {value}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {p}_{name} counter")
+                lines.append(f"{p}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class TraceLog:
+    """
+    Buffered JSONL trace of every LLM call, flushed every flush_every records or flush_interval seconds.
+    One instance per file, shared by every agent writing to it.
+    """
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def for_path(cls, path):
+        with cls._instances_lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
+
+    def __init__(self, path, flush_every=50, flush_interval=5.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def write(self, record):
+        with self.lock:
+            self.buffer.append(json.dumps(record, ensure_ascii=False) + "\n")
+            if len(self.buffer) >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            with open(self.path, "a") as file:
+                file.write("".join(self.buffer))
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+
+# Process-wide registry, read by the /metrics route
+metrics = Metrics()
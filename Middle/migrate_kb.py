@@ -0,0 +1,35 @@
+"""
+Converts a single-file KB into the sharded layout (one file per top-level domain plus a manifest).
+    python migrate_kb.py KB/permanent.json            -> KB/permanent/
+    python migrate_kb.py KB/users/alice/permanent.json --out /tmp/alice
+Anything still in the old file's write-ahead log is folded in first. The old file is renamed to
+<file>.migrated (unless --keep), so Memory picks up the sharded copy from the same path afterwards.
+"""
+from storage_module import JournaledStore, ShardedStore
+import argparse
+import os
+
+def migrate(path, out_dir=None, keep=False):
+    out_dir = out_dir or os.path.splitext(path)[0]
+    if os.path.exists(os.path.join(out_dir, "manifest.json")):
+        raise FileExistsError(f"{out_dir} already holds a sharded KB")
+    state = JournaledStore(path).load()
+    ShardedStore.create(out_dir, state)
+    if not keep:
+        os.replace(path, path + ".migrated")
+        if os.path.exists(path + ".wal"):
+            os.remove(path + ".wal")
+    return out_dir, len(state["data"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split a permanent.json KB into per-domain shards")
+    parser.add_argument("paths", nargs="+", help="permanent.json files to migrate")
+    parser.add_argument("--out", help="output directory (only with a single input), defaults to the path without .json")
+    parser.add_argument("--keep", action="store_true", help="leave the original file in place")
+    args = parser.parse_args()
+    if args.out and len(args.paths) > 1:
+        parser.error("--out only works with a single input file")
+
+    for path in args.paths:
+        out_dir, domains = migrate(path, args.out, args.keep)
+        print(f"{path} -> {out_dir} ({domains} domains)")
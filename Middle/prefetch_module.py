@@ -0,0 +1,110 @@
+from collections import deque
+from compaction_module import similarity
+from metrics_module import metrics
+import threading
+import time
+
+
+class Speculation:
+    """
+    Context extraction + retrieval run ahead of time for one draft of the user's message
+    """
+    def __init__(self, draft, context_version):
+        self.draft = draft
+        self.context_version = context_version # the convo context it was computed against
+        self.created = time.monotonic()
+        self.future = None # -> (new_context, retrieved facts)
+        self.tokens = 0 # LLM tokens it cost
+        self.discarded = False # dropped from the cache, whatever it still costs is wasted
+
+
+class PrefetchCache:
+    """
+    Short-lived, per-session cache of speculative turn preparation, keyed by draft similarity.
+    A turn reuses the best speculation whose draft is at least min_similarity close to the final message
+    (and was computed against the same convo context), if it has already finished: its LLM calls run in the background lane,
+    which yields to every reply waiting on the rate limiter, so waiting for an unfinished one could take longer than
+    starting over. Once the message is sent every other speculation is stale;
+    tokens spent on speculations that never got used are counted as wasted.
+    Speculation stops when max_tokens_per_minute have been spent on it in the last minute.
+    """
+    def __init__(self, ttl=30.0, max_entries=4, min_similarity=0.75, max_tokens_per_minute=4000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.min_similarity = min_similarity
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.entries = [] # oldest first
+        self.spend = deque() # (time, tokens) over the last minute
+        self.lock = threading.Lock()
+
+    def _discard(self, entries):
+        # Called with self.lock held
+        for entry in entries:
+            entry.discarded = True
+            entry.future.cancel() # only stops it if it hasn't started yet
+        wasted = sum(entry.tokens for entry in entries)
+        if wasted:
+            metrics.count("prefetch_wasted_tokens_total", wasted)
+
+    def _expire(self):
+        # Called with self.lock held
+        now = time.monotonic()
+        expired = [entry for entry in self.entries if now - entry.created > self.ttl]
+        if expired:
+            self.entries = [entry for entry in self.entries if entry not in expired]
+            self._discard(expired)
+        while self.spend and now - self.spend[0][0] > 60:
+            self.spend.popleft()
+
+    def start(self, draft, context_version, submit):
+        """
+        Starts a Speculation for draft with submit(entry) -> future, and returns it.
+        Returns None if it isn't worth it: one is already running, a close enough draft is cached,
+        or the speculative budget is spent
+        """
+        with self.lock:
+            self._expire()
+            if any(not entry.future.done() for entry in self.entries):
+                return None
+            if any(entry.context_version == context_version and similarity(entry.draft, draft) >= 0.9 for entry in self.entries):
+                return None
+            if sum(tokens for _, tokens in self.spend) >= self.max_tokens_per_minute:
+                metrics.count("prefetch_over_budget_total")
+                return None
+            entry = Speculation(draft, context_version)
+            try:
+                entry.future = submit(entry)
+            except RuntimeError: # the session is closing
+                return None
+            self.entries.append(entry)
+            if len(self.entries) > self.max_entries:
+                self._discard([self.entries.pop(0)])
+        metrics.count("prefetch_started_total")
+        return entry
+
+    def charge(self, entry, tokens):
+        with self.lock:
+            entry.tokens += tokens
+            self.spend.append((time.monotonic(), tokens))
+            discarded = entry.discarded
+        metrics.count("prefetch_tokens_total", tokens)
+        if discarded and tokens:
+            metrics.count("prefetch_wasted_tokens_total", tokens)
+
+    def take(self, message, context_version):
+        """
+        Best matching finished speculation for the message that was actually sent, or None. Clears the cache either way.
+        """
+        with self.lock:
+            self._expire()
+            if not self.entries:
+                return None
+            candidates = [(similarity(entry.draft, message), entry) for entry in self.entries
+                          if entry.context_version == context_version and entry.future.done()]
+            score, best = max(candidates, key=lambda candidate: candidate[0], default=(0.0, None))
+            if best is None or score < self.min_similarity:
+                best = None
+            self._discard([entry for entry in self.entries if entry is not best])
+            self.entries = []
+        metrics.count("prefetch_hits_total" if best is not None else "prefetch_misses_total")
+        return best
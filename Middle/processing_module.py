@@ -1,25 +1,44 @@
-from learning_module import Learner
+from learning_module import Learner, LearningQueue
+from compaction_module import FactCompactor
 from retrieval_module import Memory
 from groq_interface import Groq_Agent
-from collections import deque
+from cache_module import ResponseCache
+from metrics_module import metrics
+from context_module import ContextManager, truncate_to_tokens
+from rate_limit_module import PRIORITY_BACKGROUND
+from routing_module import SPECULATIVE_PREFIX
+from prefetch_module import PrefetchCache
+from index_module import tokenize
+from prompt_module import prompts
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import re
 import os
 
 # Processing module
 class Conversationalist:
-    def __init__(self, context_limit = 20000, model="llama3-70b-8192", groq_api_key = os.getenv("GROQ_API_KEY")) -> None:
+    def __init__(self, context_limit = 1500, model="llama3-70b-8192", groq_api_key = os.getenv("GROQ_API_KEY"), retrieval_mode="index", use_cache=False,
+                 llm: Groq_Agent = None, memory: Memory = None, kb_path="KB/permanent.json", summary_limit=400, prompt_budget=3000,
+                 learn_batch_size=4, learn_idle_seconds=60.0, planner=False, max_field_tokens=120, greeting_pool_size=3,
+                 prefetch_tokens_per_minute=4000, use_embeddings=False) -> None:
         # Init for this module itself
         self.current_convo_msgs_num = 0
-        self.current_convo_context = deque();
-        self.current_convo_context_size = 0 # How many characters we have in our current convo context
-        self.convo_context_size_limit = context_limit # how many characters we can have in our context size
+        # Recent context is kept verbatim up to context_limit tokens, older context gets folded into a rolling summary.
+        # prompt_budget caps summary + recent context + retrieved facts + the user's message
+        self.context = ContextManager(history_budget=context_limit, summary_budget=summary_limit,
+                                      prompt_budget=prompt_budget, summarizer=self._summarize_context)
         self.context_string = ""
 
-        # Init for groq interface
-        self.llm = Groq_Agent(groq_api_key, model=model)
+        # Init for groq interface (can be shared, e.g. by all sessions of one user)
+        # Opt-in cache for the low temperature extraction/merge prompts
+        if llm is None:
+            llm = Groq_Agent(groq_api_key, model=model, cache=ResponseCache() if use_cache else None)
+        self.llm = llm
 
         # Init for memory
-        self.memory = Memory(self.llm)
+        if memory is None:
+            memory = Memory(self.llm, path_to_permanent_data=kb_path, retrieval_mode=retrieval_mode, use_embeddings=use_embeddings)
+        self.memory = memory
         self.user_name = self.memory.get_basic_info("name") 
         self.preferred_lang = self.memory.get_basic_info("preferred_lang")
         self.other_langs = self.memory.get_basic_info("alt_langs")
@@ -33,21 +52,50 @@ class Conversationalist:
         self.date = self.memory.get_date() # returned in string format
 
         # Init for learner
+        # Learning happens after the reply has gone out, on its own worker, which also persists memory.
+        # Turns are learned in batches of learn_batch_size (None to learn every turn on its own)
         self.learner = Learner(self.memory,self.llm)
+        # Fields that grew past max_field_tokens get compacted on the same worker, right after learning
+        self.compactor = FactCompactor(self.memory, self.llm, max_field_tokens=max_field_tokens)
+        self.learning_queue = LearningQueue(self.learner, on_learned=self._after_learning,
+                                            batch_size=learn_batch_size, idle_seconds=learn_idle_seconds)
+
+        # Context extraction and retrieval don't depend on each other, so they run side by side
+        self.stage_pool = ThreadPoolExecutor(max_workers=2)
+        # Background LLM work that isn't learning (folding old context, refilling greetings) gets its own worker,
+        # so it never holds up the next turn's stages
+        self.background_pool = ThreadPoolExecutor(max_workers=1)
+
+        # Planner mode: one call per turn does both context extraction and key selection
+        self.planner = planner
+
+        # Greetings are generated ahead of time (at the end of a convo, and after one is used), start_convo just serves one
+        self.greeting_pool_size = greeting_pool_size
+        self.wrapped_up = False # end of convo job already ran, and nothing was said since
+
+        # Drafts the UI sends while the user is typing get context extraction and retrieval done ahead of time,
+        # on their own worker, so they never hold up a real turn. Capped at prefetch_tokens_per_minute of LLM spend
+        self.prefetch_cache = PrefetchCache(max_tokens_per_minute=prefetch_tokens_per_minute)
+        self.speculation_pool = ThreadPoolExecutor(max_workers=1)
+
+    def _after_learning(self):
+        self.memory.write_to_disk()
+        if self.compactor.run():
+            self.memory.write_to_disk()
 
     def _get_convo_context(self, actor, query):
+        (_, resp, size) = self.llm.make_query(self._context_prompt(query), temp=0.2, stage="context_extraction")
+        return self._parse_context(actor, resp)
+
+    async def _get_convo_context_async(self, actor, query):
+        (_, resp, size) = await self.llm.make_query_async(self._context_prompt(query), temp=0.2, stage="context_extraction")
+        return self._parse_context(actor, resp)
+
+    def _context_prompt(self, query):
         # prompt to extract context given previous context
-        prompt = f"""
-        Context up till now: {self.context_string}\n, 
-        Using this, extract all useful information(be concise, but do not skip any imp. information) from the newest query:\n {query}\n,
-        and return it in this format, 
-        <CT>
-        .....
-        <CT>
-        FOR YOUR SAKE, do not return any extra text outside the <context> clause!!!
-        Be concise, feel free to return an empty string if you feel there's no useful information
-        """
-        (_, resp, size) = self.llm.make_query(prompt, temp=0.2)
+        return prompts.render("context_extraction", context=self.context_string, query=query)
+
+    def _parse_context(self, actor, resp):
         # Extract context between tags from LLM response
         if resp:
             try:
@@ -67,81 +115,290 @@ class Conversationalist:
         # Return empty context if extraction failed
         return (actor, "", 0)
     
+    def _plan_turn(self, actor, query):
+        """
+        Single call that returns both the context summary and the retrieval keys.
+        Returns (new_context, hierarchical_keys), or None if the response isn't exactly in the expected format
+        """
+        (_, resp, _) = self.llm.make_query(self._plan_prompt(query), temp=0.2, stage="planner")
+        return self._parse_plan(actor, resp)
+
+    async def _plan_turn_async(self, actor, query):
+        (_, resp, _) = await self.llm.make_query_async(self._plan_prompt(query), temp=0.2, stage="planner")
+        return self._parse_plan(actor, resp)
+
+    def _plan_prompt(self, query):
+        return prompts.render("planner", outline=self.memory.kb_outline(), context=self.context_string, query=query)
+
+    def _parse_plan(self, actor, resp):
+        if resp is None:
+            return None
+        plan = re.fullmatch(r"\s*<CT>(.*?)</CT>\s*<keys>(.*?)</keys>\s*", resp, re.DOTALL)
+        if plan is None:
+            return None
+        hierarchical_keys = []
+        for line in plan.group(2).strip().split("\n"):
+            if line.strip() == "":
+                continue
+            domain, sep, fields = line.partition("|")
+            if sep == "" or domain.strip() not in self.memory.field_data:
+                return None
+            hierarchical_keys.append([domain.strip()] + [field.strip() for field in fields.split(",") if field.strip()])
+        context_summary = plan.group(1).strip()
+        return (actor, context_summary, len(context_summary)), hierarchical_keys
+
     def _add_convo_context(self, new_context):
-        # Get only as much context as you have space for
         if new_context[1].strip() == "":
             # Don't bother adding negligible context
             return
-        if self.current_convo_context_size + new_context[2] <= self.convo_context_size_limit:
-            self.current_convo_context.append(new_context)
-            self.current_convo_msgs_num += 1 # Keep track of how many significant messages have come in the convo so far
-            self.current_convo_context_size += new_context[2]
-            # return 1
-        else:
-            # out of space, shed earlier context
-            while self.current_convo_context_size > self.convo_context_size_limit:
-                self.current_convo_context_size -= self.current_convo_context.popleft()[2]
-            # return 0
-        
+        # The context manager evicts the oldest turns into its summary if this goes over budget
+        self.context.add(new_context[0], new_context[1])
+        self.current_convo_msgs_num += 1 # Keep track of how many significant messages have come in the convo so far
+        self.wrapped_up = False
+
     def _return_context(self):
-        out_string = ""
-        for (actor, info, _) in self.current_convo_context:
-            out_string += f"{actor}:{info}\n"
-        return out_string
+        return self.context.render()
+
+    def _summarize_context(self, text, token_budget):
+        # Used by the context manager to fold evicted turns, runs in the background
+        prompt = prompts.render("context_summary", token_budget=token_budget, text=text)
+        (_, resp, _) = self.llm.make_query(prompt, temp=0.2, priority=PRIORITY_BACKGROUND, stage="context_summary")
+        if resp is None:
+            return None
+        summary = re.search(r"<SUM>(.*?)<(?:\\|/)?SUM>", resp, re.DOTALL)
+        return summary.group(1).strip() if summary is not None else None
 
     def start_convo(self):
-        # Just starting the convo, use convo start general info and prev context
-        prompt = f"""
-            Here's some general info about {self.user_name}:
-            {self.general_convo_start_info}
-            and here's what you guys spoke about last time:
-            {self.recent_context}
-            Most important thing: BE COOL, adapt to the guy
-            Please respond as if you were the user's personal friend, 
-            from the 2nd person perspective as if talking directly to the user.
-            Feel free to ignore any useless information. 
-            For simple interactions, like a simple hi, just say hi to the user.
-            Don't be verbose, be cool, talk as if you were actually his friend. 
-            Try to mimic normal human interaction as far as you can, be platonic and absolutely no romantic or sexual references.
-            Also, you're not a physical human being, so you know, don't talk about going out to drinks or whatever
-        """
-        (_,hello_msg, _) = self.llm.make_query(prompt, temp=0.9)
+        """
+        Serves a pre-generated greeting and tops the pool back up in the background.
+        Generates one on the spot if the pool is empty, or if something's happening today (so it can be mentioned).
+        """
+        _, _, events_today = self.memory.today_info()
+        hello_msg = None if events_today else self.memory.pop_greeting()
+        if hello_msg is None:
+            (_,hello_msg, _) = self.llm.make_query(self._greeting_prompt(events_today), temp=0.9, stage="greeting")
+        self.background_pool.submit(self._refill_greetings)
         return hello_msg
 
-    def process_query(self, user_query):
+    def _greeting_prompt(self, events_today=(), count=None):
+        # Just starting the convo, use convo start general info and prev context
+        today = f"Happening today: {'; '.join(events_today)}" if events_today else ""
+        if count is None:
+            output = "Return just the greeting."
+        else:
+            # The next few sessions' greetings in one call
+            output = f"Write {count} different greetings, each one inside its own <G>...</G> tags, and nothing else."
+        return prompts.render("greeting", user_name=self.user_name, general_info=self.general_convo_start_info,
+                              recent_context=self.recent_context, today=today, output=output)
+
+    def _refill_greetings(self, replace=False):
+        # Background: generate whatever the pool is missing. replace=True starts it over (the last convo changed)
+        with self.memory.lock:
+            pool = [] if replace else list(self.memory.convo_start_info.get("greetings") or [])
+        missing = self.greeting_pool_size - len(pool)
+        if missing <= 0:
+            return
+        (_, resp, _) = self.llm.make_query(self._greeting_prompt(count=missing), temp=0.9, priority=PRIORITY_BACKGROUND, stage="greeting")
+        greetings = [g.strip() for g in re.findall(r"<G>(.*?)</G>", resp or "", re.DOTALL) if g.strip()]
+        if not greetings:
+            return
+        with self.memory.lock:
+            # Another session of the same user may have refilled it in the meantime
+            pool = [] if replace else list(self.memory.convo_start_info.get("greetings") or [])
+            self.memory.set_convo_starter("greetings", (pool + greetings)[:self.greeting_pool_size])
+        self.memory.write_to_disk()
+
+    def _wrap_up(self):
+        """
+        End of convo job: the convo's summary becomes next time's "what you spoke about last time",
+        and the greeting pool is regenerated from it
+        """
+        text = self.context.render()
+        if self.wrapped_up or text.strip() == "":
+            return None
+        self.wrapped_up = True
+        summary = self._summarize_context(text, 150)
+        if not summary:
+            summary = " ".join(truncate_to_tokens(text, 150, keep_end=True).split("\n"))
+        self.memory.set_convo_starter("prev_context", summary)
+        self.recent_context = summary
+        self._refill_greetings(replace=True)
+        return None
+
+    def _learning_stuff(self, user_query):
         # Pass query and user context to learning module so it can learn from the user's responses
         # Current convo context is an ordered list of extracted info from earlier parts of the convo
-        # Send computed new context to llm
-        new_context = self._get_convo_context(self.user_name, user_query)
-        self._add_convo_context(new_context)
-        learning_stuff = f"""
+        return f"""
         Summary of conversation so far:
         {self.context_string}
 
         User's last interaction: {user_query}
         """
-        extra_context_string = self.memory.retrieve(learning_stuff) # improperly named, but whatever
-        self.last_learned_thing = self.learner.learn_from_query(learning_stuff, extra_context_string)
-        finalized_prompt = f"""
-        You're having a casual conversation with someone:
-        What they said last: "{user_query}"
-        Now, for context:
-        Summary of conversation so far:
-        {self.context_string}
 
-        Retrieved context related to query:
-        {extra_context_string}
+    def _retrieval_query(self, user_query):
+        # What retrieval searches with: the convo so far and the message, without _learning_stuff's fixed wording,
+        # which would otherwise match "summary", "conversation", "user"... on every turn
+        return f"{self.context_string}\n{user_query}"
 
-        Instructions:
-        1. CONTINUE the conversation as their personal friend, try to mimic normal human interaction as far as you can.
-        2. Talk from the 2nd person POV, talking directly to the user.
-        3. Feel free to ignore any useless information. And feel more than free to ask when you don't know. 
-        4. You don't have to respond to everything he says!!
-        5. Don't be verbose, be cool.
-        6. Also, you're not a physical human being, so you know, don't talk about going out to drinks or whatever
+    def prefetch(self, draft):
         """
+        Starts context extraction and retrieval for a draft of the next message in the background.
+        Returns True if it did, False if it wasn't worth it (draft too short, already prefetched, over budget)
+        """
+        if len(tokenize(draft)) < 3:
+            return False
+        return self.prefetch_cache.start(draft, self.context_string, self._submit_speculation) is not None
+
+    def _submit_speculation(self, entry):
+        return self.speculation_pool.submit(self._speculate, entry)
+
+    def _speculate(self, entry):
+        # Same as the separate calls of _prepare_turn, at background priority, with the tokens charged to the entry
+        (in_tokens, resp, out_tokens) = self.llm.make_query(self._context_prompt(entry.draft), temp=0.2, priority=PRIORITY_BACKGROUND,
+                                                            stage=SPECULATIVE_PREFIX + "context_extraction")
+        self.prefetch_cache.charge(entry, in_tokens + out_tokens)
+        spent = []
+        extra_context_string = self.memory.retrieve(self._retrieval_query(entry.draft), spent=spent)
+        self.prefetch_cache.charge(entry, sum(spent))
+        return self._parse_context(self.user_name, resp), extra_context_string
+
+    def _take_prefetched(self, user_query):
+        # The speculation to use for this turn, if a draft close enough to the message was prefetched
+        entry = self.prefetch_cache.take(user_query, self.context_string)
+        return entry.future if entry is not None else None
+
+    def _prepare_turn(self, user_query):
+        # Send computed new context to llm
+        learning_stuff = self._learning_stuff(user_query)
+        prefetched = self._take_prefetched(user_query)
+        if prefetched is not None:
+            try:
+                # Already finished, take() doesn't hand out running ones
+                new_context, extra_context_string = prefetched.result()
+                finalized_prompt, extra_context_string = self._reply_prompt(user_query, new_context, extra_context_string)
+                return finalized_prompt, learning_stuff, extra_context_string
+            except Exception as e:
+                print(f"Prefetched retrieval failed, redoing it: {str(e)}")
+        plan = self._plan_turn(self.user_name, user_query) if self.planner else None
+        if plan is not None:
+            new_context, hierarchical_keys = plan
+            extra_context_string = self.memory.retrieve_by_keys(hierarchical_keys)
+        else:
+            # Separate calls (also the fallback when the planner's output didn't parse)
+            context_job = self.stage_pool.submit(self._get_convo_context, self.user_name, user_query)
+            retrieval_job = self.stage_pool.submit(self.memory.retrieve, self._retrieval_query(user_query))
+            new_context = context_job.result()
+            extra_context_string = retrieval_job.result() # improperly named, but whatever
+        finalized_prompt, extra_context_string = self._reply_prompt(user_query, new_context, extra_context_string)
+        return finalized_prompt, learning_stuff, extra_context_string
+
+    async def _prepare_turn_async(self, user_query):
+        # Same as _prepare_turn, with the LLM calls awaited instead of run on the stage pool
+        learning_stuff = self._learning_stuff(user_query)
+        prefetched = self._take_prefetched(user_query)
+        if prefetched is not None:
+            try:
+                new_context, extra_context_string = await asyncio.wrap_future(prefetched)
+                finalized_prompt, extra_context_string = self._reply_prompt(user_query, new_context, extra_context_string)
+                return finalized_prompt, learning_stuff, extra_context_string
+            except Exception as e:
+                print(f"Prefetched retrieval failed, redoing it: {str(e)}")
+        plan = await self._plan_turn_async(self.user_name, user_query) if self.planner else None
+        if plan is not None:
+            new_context, hierarchical_keys = plan
+            extra_context_string = await asyncio.to_thread(self.memory.retrieve_by_keys, hierarchical_keys)
+        else:
+            new_context, extra_context_string = await asyncio.gather(
+                self._get_convo_context_async(self.user_name, user_query),
+                self.memory.retrieve_async(self._retrieval_query(user_query)))
+        finalized_prompt, extra_context_string = self._reply_prompt(user_query, new_context, extra_context_string)
+        return finalized_prompt, learning_stuff, extra_context_string
+
+    def _reply_prompt(self, user_query, new_context, extra_context_string):
+        self._add_convo_context(new_context)
+        # Only as many retrieved facts as the prompt budget allows (they come best first)
+        extra_context_string = self.context.fit_facts(extra_context_string, user_query)
+        finalized_prompt = prompts.render("reply", context=self.context_string, facts=extra_context_string, query=user_query)
 
         self.context_string = self._return_context()
-        _, response, _ = self.llm.make_query(finalized_prompt, temp=0.7)
-        self.memory.write_to_disk() # write to disk at the end of each query
-        return response
\ No newline at end of file
+        return finalized_prompt, extra_context_string
+
+    def process_query(self, user_query):
+        with metrics.stage("turn"):
+            finalized_prompt, learning_stuff, extra_context_string = self._prepare_turn(user_query)
+            _, response, _ = self.llm.make_query(finalized_prompt, temp=0.7, stage="reply")
+        self._fold_context_later()
+        # Learn (and write to disk) in the background, the user doesn't have to wait for it
+        self.learning_queue.submit(learning_stuff, extra_context_string, user_message=user_query)
+        return response
+
+    def process_query_stream(self, user_query):
+        """
+        Same as process_query, but yields the reply chunk by chunk
+        """
+        finalized_prompt, learning_stuff, extra_context_string = self._prepare_turn(user_query)
+        try:
+            yield from self.llm.make_query_stream(finalized_prompt, temp=0.7, stage="reply")
+        finally:
+            self.learning_queue.submit(learning_stuff, extra_context_string, user_message=user_query)
+            self._fold_context_later()
+
+    async def process_query_async(self, user_query):
+        """
+        process_query for the async server: nothing blocks the event loop, and cancelling
+        the coroutine (timeout, client gone) cancels the LLM call in flight
+        """
+        with metrics.stage("turn"):
+            finalized_prompt, learning_stuff, extra_context_string = await self._prepare_turn_async(user_query)
+            _, response, _ = await self.llm.make_query_async(finalized_prompt, temp=0.7, stage="reply")
+        self._fold_context_later()
+        self.learning_queue.submit(learning_stuff, extra_context_string, user_message=user_query)
+        return response
+
+    async def process_query_stream_async(self, user_query):
+        finalized_prompt, learning_stuff, extra_context_string = await self._prepare_turn_async(user_query)
+        completed = False
+        try:
+            async for chunk in self.llm.make_query_stream_async(finalized_prompt, temp=0.7, stage="reply"):
+                yield chunk
+            completed = True
+        finally:
+            # Unlike the sync stream, a reply that got cancelled halfway isn't learned from
+            if completed:
+                self.learning_queue.submit(learning_stuff, extra_context_string, user_message=user_query)
+            self._fold_context_later()
+
+    def _fold_context_later(self):
+        # Summarizing evicted context costs an LLM call, do it after the reply
+        if self.context.needs_fold():
+            self.background_pool.submit(self.context.fold)
+
+    @property
+    def last_learned_thing(self):
+        return self.learning_queue.last_learned_thing
+
+    def end_convo(self):
+        """
+        Waits for pending learning to finish, so nothing is lost when the convo is over,
+        then saves the convo's summary and next time's greetings
+        """
+        self.learning_queue.submit_job(self._wrap_up)
+        self.learning_queue.flush()
+
+    def flush_learning(self, wait=True):
+        """
+        Gets pending learning into Memory (not onto disk), without ending the convo
+        """
+        self.learning_queue.flush(wait)
+
+    def close(self, wrap_up=True):
+        """
+        Finishes pending learning (and, with wrap_up, the end of convo job) and stops this convo's worker threads.
+        Without wrap_up no more LLM calls are made, other than the ones pending learning needs
+        """
+        if wrap_up:
+            self.learning_queue.submit_job(self._wrap_up)
+        self.learning_queue.stop()
+        self.speculation_pool.shutdown(cancel_futures=True)
+        self.background_pool.shutdown(cancel_futures=not wrap_up)
+        self.stage_pool.shutdown()
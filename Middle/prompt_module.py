@@ -0,0 +1,348 @@
+"""
+Every prompt the agent sends, in one place. A template is its static instructions first, then a body with
+the per-call parts ({slots}) last, so consecutive calls of the same kind start with the exact same text
+(the system prompt + the instructions) and providers that cache prompt prefixes get to reuse it.
+Templates are dedented, parsed and token counted once, at import. Slots can have a token budget,
+values over it get cut down (whole lines first, the end or the start depending on the slot).
+"""
+from collections import OrderedDict, defaultdict
+from context_module import count_tokens, truncate_to_tokens
+from string import Formatter
+import hashlib
+import textwrap
+import threading
+
+
+class Prompt(str):
+    """
+    A rendered template: a plain string that also knows which template it came from and where its static prefix ends
+    """
+    def __new__(cls, text, template, prefix_chars):
+        prompt = super().__new__(cls, text)
+        prompt.template = template
+        prompt.prefix_chars = prefix_chars
+        return prompt
+
+
+class PromptTemplate:
+    def __init__(self, name, instructions, body, budgets=None, keep_end=()):
+        self.name = name
+        self.prefix = textwrap.dedent(instructions).strip() + "\n\n"
+        self.body = textwrap.dedent(body).strip()
+        self.slots = [field for _, field, _, _ in Formatter().parse(self.body) if field is not None]
+        self.budgets = budgets or {} # slot -> max tokens
+        self.keep_end = set(keep_end) # slots where the most recent (last) lines matter most
+        unknown = set(self.budgets) - set(self.slots)
+        if unknown:
+            raise ValueError(f"Prompt {name}: budget for unknown slots {unknown}")
+        self.prefix_tokens = count_tokens(self.prefix)
+
+    def fill(self, values):
+        """
+        Returns (prompt, truncated tokens)
+        """
+        missing = set(self.slots) - set(values)
+        if missing:
+            raise KeyError(f"Prompt {self.name}: missing {missing}")
+        truncated = 0
+        values = {slot: "" if value is None else str(value) for slot, value in values.items()}
+        for slot, budget in self.budgets.items():
+            tokens = count_tokens(values[slot])
+            if tokens > budget:
+                values[slot] = truncate_to_tokens(values[slot], budget, keep_end=slot in self.keep_end)
+                truncated += tokens - count_tokens(values[slot])
+        return Prompt(self.prefix + self.body.format(**values), self.name, len(self.prefix)), truncated
+
+
+class PromptRegistry:
+    """
+    The compiled templates, plus per-template counters: renders, tokens rendered, truncations,
+    and how often a request started with a prefix (system prompt + instructions, per model)
+    that was already sent recently, i.e. could be served from the provider's prompt cache.
+    """
+    def __init__(self, templates, recent_prefixes=256):
+        self.templates = {template.name: template for template in templates}
+        self.recent_prefixes = recent_prefixes
+        self.seen = OrderedDict() # prefix hash -> None, most recently sent last
+        self.lock = threading.Lock()
+        self.renders = defaultdict(int)
+        self.tokens = defaultdict(int)
+        self.truncations = defaultdict(int)
+        self.truncated_tokens = defaultdict(int)
+        self.prefix_hits = defaultdict(int)
+        self.prefix_misses = defaultdict(int)
+        self.prefix_hit_tokens = defaultdict(int) # tokens of the reused prefixes (instructions only)
+
+    def render(self, name, **values):
+        template = self.templates[name]
+        prompt, truncated = template.fill(values)
+        tokens = template.prefix_tokens + count_tokens(prompt[prompt.prefix_chars:])
+        with self.lock:
+            self.renders[name] += 1
+            self.tokens[name] += tokens
+            if truncated:
+                self.truncations[name] += 1
+                self.truncated_tokens[name] += truncated
+        return prompt
+
+    def observe_prefix(self, model, system_prompt, query):
+        # Called by the LLM interface for every request, only templated prompts are tracked
+        if not isinstance(query, Prompt):
+            return
+        key = hashlib.sha1(f"{model}\0{system_prompt}\0{query[:query.prefix_chars]}".encode()).hexdigest()
+        with self.lock:
+            if key in self.seen:
+                self.seen.move_to_end(key)
+                self.prefix_hits[query.template] += 1
+                self.prefix_hit_tokens[query.template] += self.templates[query.template].prefix_tokens
+                return
+            self.seen[key] = None
+            if len(self.seen) > self.recent_prefixes:
+                self.seen.popitem(last=False)
+            self.prefix_misses[query.template] += 1
+
+    def stats(self):
+        """
+        {template: {prefix_tokens, renders, avg_tokens, truncations, truncated_tokens, prefix_hits, prefix_misses}}
+        """
+        with self.lock:
+            return {name: {"prefix_tokens": template.prefix_tokens,
+                           "renders": self.renders[name],
+                           "avg_tokens": round(self.tokens[name] / self.renders[name], 1) if self.renders[name] else 0,
+                           "truncations": self.truncations[name],
+                           "truncated_tokens": self.truncated_tokens[name],
+                           "prefix_hits": self.prefix_hits[name],
+                           "prefix_misses": self.prefix_misses[name]}
+                    for name, template in self.templates.items()}
+
+    def render_metrics(self, prefix="him"):
+        """
+        Prometheus text exposition format, appended to the /metrics output
+        """
+        lines = [f"# TYPE {prefix}_prompt_prefix_tokens gauge"]
+        for name, template in sorted(self.templates.items()):
+            lines.append(f'{prefix}_prompt_prefix_tokens{{template="{name}"}} {template.prefix_tokens}')
+        with self.lock:
+            for metric, values in (("prompt_renders_total", self.renders), ("prompt_tokens_total", self.tokens),
+                                   ("prompt_truncations_total", self.truncations), ("prompt_truncated_tokens_total", self.truncated_tokens),
+                                   ("prompt_prefix_hits_total", self.prefix_hits), ("prompt_prefix_misses_total", self.prefix_misses),
+                                   ("prompt_prefix_hit_tokens_total", self.prefix_hit_tokens)):
+                lines.append(f"# TYPE {prefix}_{metric} counter")
+                for name, value in sorted(values.items()):
+                    lines.append(f'{prefix}_{metric}{{template="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+TEMPLATES = [
+    PromptTemplate("reply", """
+        You're having a casual conversation with someone.
+        Instructions:
+        1. CONTINUE the conversation as their personal friend, try to mimic normal human interaction as far as you can.
+        2. Talk from the 2nd person POV, talking directly to the user.
+        3. Feel free to ignore any useless information. And feel more than free to ask when you don't know.
+        4. You don't have to respond to everything he says!!
+        5. Don't be verbose, be cool.
+        6. Also, you're not a physical human being, so you know, don't talk about going out to drinks or whatever
+        """, """
+        Summary of conversation so far:
+        {context}
+
+        Retrieved context related to query:
+        {facts}
+
+        What they said last: "{query}"
+        """),
+
+    PromptTemplate("context_extraction", """
+        Using the context up till now, extract all useful information (be concise, but do not skip any imp. information)
+        from the newest query, and return it in this format:
+        <CT>
+        .....
+        <CT>
+        FOR YOUR SAKE, do not return any extra text outside the <CT> clause!!!
+        Feel free to return an empty string if you feel there's no useful information
+        """, """
+        Context up till now: {context}
+        Newest query: {query}
+        """),
+
+    PromptTemplate("planner", """
+        1. Extract all useful information from the newest query, given the context (be concise, can be empty)
+        2. Choose the knowledge base fields worth looking up to answer it. Retrieve less for generic queries,
+           only pick basic info when the query is actually about it.
+        Return EXACTLY this and nothing else
+        <CT>
+        ...
+        </CT>
+        <keys>
+        domain | field, field
+        ...
+        </keys>
+        """, """
+        My knowledge base, one "domain: field,field,..." per line:
+        {outline}
+
+        Context up till now: {context}
+        Newest query: {query}
+        """, budgets={"outline": 1500}),
+
+    PromptTemplate("context_summary", """
+        Below are notes from an earlier part of a conversation.
+        Merge them into one summary, keep names, dates, plans and feelings, drop small talk.
+        Return it in this format, and nothing else:
+        <SUM>
+        ...
+        <SUM>
+        """, """
+        Summary length: at most {token_budget} tokens
+        Notes:
+        {text}
+        """),
+
+    PromptTemplate("greeting", """
+        You're starting a new conversation with a friend.
+        Most important thing: BE COOL, adapt to the guy
+        Please respond as if you were the user's personal friend,
+        from the 2nd person perspective as if talking directly to the user.
+        Feel free to ignore any useless information.
+        For simple interactions, like a simple hi, just say hi to the user.
+        Don't be verbose, be cool, talk as if you were actually his friend.
+        Try to mimic normal human interaction as far as you can, be platonic and absolutely no romantic or sexual references.
+        Also, you're not a physical human being, so you know, don't talk about going out to drinks or whatever
+        """, """
+        Here's some general info about {user_name}:
+        {general_info}
+        and here's what you guys spoke about last time:
+        {recent_context}
+        {today}
+        {output}
+        """, budgets={"general_info": 600, "recent_context": 400}),
+
+    PromptTemplate("key_generation_fields", """
+        I want you to select search keys from my knowledge base for the context + query below,
+        and return them in this format:
+        <keys>
+        top_level_field
+        ...
+        <\\keys>
+        1. Do not generate any text outside the <keys>
+        2. Only generate top level fields
+        """, """
+        Here are the top level fields in my knowledge base: {fields}
+        Here is the context + query: {query}
+        """, budgets={"fields": 800}),
+
+    PromptTemplate("key_generation_subfields", """
+        I've chosen some fields from my knowledge base. I want you to select the subfields that seem relevant
+        to the context + query below. Return your output in the format:
+        <keys>
+        <name of a chosen top level field> | <chosen search term1>, <chosen term2> ....
+        ...
+        <\\keys>
+        1. DO NOT OUTPUT ANY TEXT OUTSIDE <keys>...<\\keys>
+        2. Retrieve less information for generic prompts.
+        3. Only retrieve basic info when user specific query is asked(e.g. his birthday celebration)
+        """, """
+        Here is a list of top_level_field | <chosen keys in top level field>:
+        {fields}
+        Here is the context + query: {query}
+        """, budgets={"fields": 1200}),
+
+    PromptTemplate("learning", """
+        You get the user's last query, the top level knowledge domains we have, and the stuff we ALREADY KNOW
+        (retrieved context, only for reference, not to be learned from).
+        1. Figure out what, if any, information is contained in the user's query that is not there in the context
+            in other words, we want to learn <info in query> - <info retrieved>
+        2. Learn only significant facts
+        Also, figure out if we need NEW top level domains i.e. NOT in the listed ones
+        Your entire output should be in this format, and contain nothing else
+        <new>
+        ...(new, single-word, top level domain) | (general info. about this domain)
+        e.g. "health | Ishaan reports being in good health"
+        <new>
+
+        <fact>
+        ...(New facts and which top level domain they come under)
+        (e.g. "<existing(/newly added)_top_level_domain> |His sister's name is <>")
+        <fact>
+        Do not return <new>...<new> and <fact>...<fact> tags, if they're empty
+        BE VERY, VERY CONCISE AND PRECISE. No text outside tags.
+        Store the facts in a personal tone
+        """, """
+        Top level knowledge domains:
+        {domains}
+
+        Retrieved context, stuff we ALREADY KNOW:
+        {retrieved}
+
+        The user's last query and the conversation so far:
+        {query}
+        """, budgets={"retrieved": 1000}),
+
+    PromptTemplate("fact_merge", """
+        You get the existing fields of one domain of my knowledge base, and new facts we want to add to it.
+        Please, for each change you're SURE you want to make to this domain's data, return an item:
+        <Add/Alter> |<single-word new/existing field_name>| "<fact_string>"
+        Return all output within <ans>.. <ans> tags, NO EXTRA TEXT
+        e.g.
+        <ans>
+        Add | sister | "Aadya, 5 years younger",
+        Alter | motivation | "After experiencing travel and parties, earning money has become a bigger motivation for Ishaan"
+        <ans>
+        This example will associate "sister" key with "Aadya, 5 years younger"
+        Also, don't assume any context, like write "that day" for "today"
+        """, """
+        Here are the existing fields of this domain:
+        {fields}
+        The new facts we want to add:
+        {facts}
+        """, budgets={"fields": 600}),
+
+    PromptTemplate("learning_batch", """
+        You get the user's messages since we last learned, the conversation so far, an outline of my knowledge base,
+        and the stuff we ALREADY KNOW (retrieved context, only for reference, not to be learned from).
+        Figure out what significant NEW information is in the messages, i.e. <info in messages> - <info retrieved>.
+        If a later message contradicts an earlier one, only keep the later one.
+        Your entire output should be in this format, and contain nothing else:
+        <new>
+        (new, single-word, top level domain NOT in the outline) | (general info. about this domain)
+        <new>
+        <ans>
+        <Add/Alter> | <domain> | <single-word new/existing field_name> | "<fact_string>"
+        <ans>
+        e.g.
+        <ans>
+        Add | family | sister | "Aadya, 5 years younger"
+        Alter | work | motivation | "After experiencing travel and parties, earning money has become a bigger motivation"
+        <ans>
+        Leave out <new>...<new> if there are no new domains, and return nothing at all if there's nothing to learn.
+        BE VERY, VERY CONCISE AND PRECISE. Store the facts in a personal tone,
+        and don't assume any context, like write "that day" for "today"
+        """, """
+        Knowledge base outline (domain: existing fields):
+        {outline}
+
+        Retrieved context, stuff we ALREADY KNOW:
+        {retrieved}
+
+        The conversation so far (as of the last message):
+        {context}
+
+        The user's messages since we last learned, oldest first:
+        {messages}
+        """, budgets={"outline": 1500, "retrieved": 1500}),
+
+    PromptTemplate("fact_compaction", """
+        Rewrite the facts I know about the user under one field of my knowledge base (listed oldest first)
+        as one short note. Keep every distinct fact, drop repeats, and if two facts contradict each other keep the newer one.
+        Separate facts with "; ". Return the note inside <SUM>...<SUM> and nothing else.
+        """, """
+        Note length: at most {max_words} words
+        Field: {domain} -> {field}
+        Facts, oldest first:
+        {facts}
+        """, budgets={"facts": 2000}, keep_end=("facts",))
+]
+
+# Compiled once, at import
+prompts = PromptRegistry(TEMPLATES)
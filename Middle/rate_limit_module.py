@@ -0,0 +1,117 @@
+import asyncio
+import os
+import threading
+import time
+
+# Priority lanes, lower is more important
+PRIORITY_REPLY = 0 # anything the user is waiting on
+PRIORITY_BACKGROUND = 1 # learning, compaction etc.
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.rate = per_minute / 60.0 # refill per second
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, floor=0.0):
+        # Seconds until `amount` can be taken without dropping below `floor`
+        missing = amount + floor - self.level
+        return 0.0 if missing <= 0 else missing / self.rate
+
+
+class RateLimiter:
+    """
+    Token-bucket scheduler for the provider's requests/min and tokens/min budgets.
+    The reply lane can spend the whole budget. The background lane has to leave background_reserve
+    of both buckets untouched, and backs off completely while a reply is waiting,
+    so learning never delays what the user is waiting on.
+    """
+    def __init__(self, requests_per_min=30, tokens_per_min=6000, background_reserve=0.25):
+        self.requests = TokenBucket(requests_per_min)
+        self.tokens = TokenBucket(tokens_per_min)
+        self.background_reserve = background_reserve
+        self.waiting_replies = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self, est_tokens, priority=PRIORITY_REPLY):
+        """
+        Takes the budget and returns 0 if the call may go ahead now,
+        otherwise returns how many seconds to wait before trying again
+        """
+        # A single call bigger than the whole bucket would never fit, let it through on a full bucket
+        est_tokens = min(est_tokens, self.tokens.capacity)
+        with self.lock:
+            self.requests.refill()
+            self.tokens.refill()
+            if priority == PRIORITY_REPLY:
+                request_floor, token_floor = 0.0, 0.0
+            else:
+                if self.waiting_replies > 0:
+                    return 0.5
+                request_floor = self.requests.capacity * self.background_reserve
+                token_floor = self.tokens.capacity * self.background_reserve
+            wait = max(self.requests.wait_time(1, request_floor), self.tokens.wait_time(est_tokens, token_floor))
+            if wait == 0:
+                self.requests.level -= 1
+                self.tokens.level -= est_tokens
+            return wait
+
+    def acquire(self, est_tokens, priority=PRIORITY_REPLY):
+        self._mark_waiting(priority, 1)
+        try:
+            while True:
+                wait = self.try_acquire(est_tokens, priority)
+                if wait == 0:
+                    return
+                time.sleep(min(wait, 5.0))
+        finally:
+            self._mark_waiting(priority, -1)
+
+    async def acquire_async(self, est_tokens, priority=PRIORITY_REPLY):
+        self._mark_waiting(priority, 1)
+        try:
+            while True:
+                wait = self.try_acquire(est_tokens, priority)
+                if wait == 0:
+                    return
+                await asyncio.sleep(min(wait, 5.0))
+        finally:
+            self._mark_waiting(priority, -1)
+
+    def _mark_waiting(self, priority, delta):
+        if priority == PRIORITY_REPLY:
+            with self.lock:
+                self.waiting_replies += delta
+
+    def settle(self, est_tokens, actual_tokens):
+        # Correct the token bucket once the real usage is known (can go negative, that just means waiting longer)
+        with self.lock:
+            self.tokens.level -= actual_tokens - min(est_tokens, self.tokens.capacity)
+
+    def penalize(self, seconds):
+        # The provider said 429 anyway: drain the buckets so nobody tries again before Retry-After
+        with self.lock:
+            self.requests.level = min(self.requests.level, -seconds * self.requests.rate)
+            self.tokens.level = min(self.tokens.level, -seconds * self.tokens.rate)
+
+
+_shared_limiter = None
+_shared_lock = threading.Lock()
+
+def shared_limiter():
+    """
+    The process-wide limiter, all agents using the same API key share its budget.
+    Budgets come from GROQ_REQUESTS_PER_MIN / GROQ_TOKENS_PER_MIN.
+    """
+    global _shared_limiter
+    with _shared_lock:
+        if _shared_limiter is None:
+            _shared_limiter = RateLimiter(int(os.getenv("GROQ_REQUESTS_PER_MIN", "30")),
+                                          int(os.getenv("GROQ_TOKENS_PER_MIN", "6000")))
+        return _shared_limiter
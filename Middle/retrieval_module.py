@@ -1,20 +1,30 @@
 from typing import List
-import json
 from datetime import datetime
+import asyncio
 import re
+import threading
 from groq_interface import Groq_Agent
+from index_module import FactIndex
+from storage_module import JournaledStore, ShardedStore, sharded_kb_dir
+from metrics_module import metrics
+from compaction_module import merge_fragments, clip_fact
+from rate_limit_module import PRIORITY_REPLY, PRIORITY_BACKGROUND
+from routing_module import SPECULATIVE_PREFIX
+from prompt_module import prompts
+import time
 
 class Memory:
     def init_temporary(self, basic_info, events):
         # Update date, time, current age
         # basic_info is a python dict
-        dob_str = basic_info["DOB"]
-        dob = datetime.strptime(dob_str, "%d/%m/%Y")
-
         today = datetime.today()
         date_str1 = today.strftime("%d/%m/%Y")  # "25/03/2025"
-        # Compute age in years
-        age = today.year - dob.year - ((today.month, today.day) < (dob.month, dob.day))
+        age = None
+        dob_str = basic_info.get("DOB")
+        if dob_str:
+            dob = datetime.strptime(dob_str, "%d/%m/%Y")
+            # Compute age in years
+            age = today.year - dob.year - ((today.month, today.day) < (dob.month, dob.day))
         
         events_today = []
         for date, description in events:
@@ -24,7 +34,16 @@ class Memory:
         return (date_str1, age, events_today)
 
 
-    def __init__(self, llm_interface: Groq_Agent, path_to_permanent_data="KB/permanent.json") -> None:
+    def __init__(self, llm_interface: Groq_Agent, path_to_permanent_data="KB/permanent.json", retrieval_mode="index", top_k=8,
+                 max_resident_shards=16, max_fact_tokens=200, use_embeddings=False) -> None:
+        # Snapshot + write-ahead log, so each write only costs as much as what changed
+        # A migrated (sharded) KB only reads its manifest here, domains are loaded when they're first used
+        shard_dir = sharded_kb_dir(path_to_permanent_data)
+        self.sharded = shard_dir is not None
+        if self.sharded:
+            self.store = ShardedStore(shard_dir, max_resident=max_resident_shards)
+        else:
+            self.store = JournaledStore(path_to_permanent_data)
         permanent_info = self.get_info(path_to_permanent_data)
         self.data = permanent_info['data']
         self.bio_data = permanent_info['bio_data']
@@ -32,14 +51,69 @@ class Memory:
         self.top_level_fields = list(self.field_data.keys())
         self.disk_path = path_to_permanent_data
         self.convo_start_info = permanent_info['convo_starter']
-        # self.init_temporary(self.basic_info, 
-                            # self.data["events"]) # Initialise temporary data file
+        # domain -> field -> {"chars", "created", "updated", "version"}, for compaction. Older KBs start without it
+        self.field_meta = permanent_info.setdefault('field_meta', {})
+        self._today = None # init_temporary() result, recomputed once a day by today_info()
         self.llm = llm_interface
+        # Learning runs in the background, so reads/writes of self.data have to be guarded
+        self.lock = threading.RLock()
+
+        # "index": rank facts with the local BM25 index, "llm": ask the LLM to pick keys (2 extra calls)
+        self.retrieval_mode = retrieval_mode
+        self.top_k = top_k
+        self.max_fact_tokens = max_fact_tokens # per retrieved fact, in case compaction hasn't caught up with a field yet
+        # use_embeddings: re-rank the lexical hits with local CPU embeddings (needs sentence-transformers)
+        self.index = FactIndex(use_embeddings=use_embeddings)
+        self._outline = None # cached kb_outline(), reset whenever a domain or field is added
+        if self.sharded:
+            # The fact index only covers resident shards, a second index over domain + field names
+            # (from the manifest) picks which shards are worth loading for a query
+            self.domain_index = FactIndex()
+            for domain, fields in self.store.outline.items():
+                self.domain_index.update(domain, "", " ".join(fields))
+            self.data.on_load = self._on_shard_load
+            self.data.on_evict = self.index.remove_domain
+            # Replaying the log already loaded the domains it touched, before the hooks were set
+            for domain, fields in list(self.data.resident.items()):
+                self._on_shard_load(domain, fields)
+        else:
+            self.index.build(self.data)
+            for domain, fields in self.data.items():
+                self._backfill_meta(domain, fields)
+
+    def _on_shard_load(self, domain, fields):
+        self.index.build_domain(domain, fields)
+        self._backfill_meta(domain, fields)
 
     def get_info(self, path_to_permanent_data):
-        # Read the permanent.json file and store it in memory
-        with open(path_to_permanent_data, "r") as file:
-            return json.load(file)
+        # Read the permanent.json file (plus anything logged since) and store it in memory
+        return self.store.load()
+
+    def today_info(self):
+        """
+        (date, age, events today), computed on the first call of the day and cached after that.
+        Events are the fields of the "events" domain, keyed by their dd/mm/yyyy date.
+        """
+        date = self.get_date()
+        with self.lock:
+            if self._today is None or self._today[0] != date:
+                events = list(self.data["events"].items()) if "events" in self.field_data else []
+                self._today = self.init_temporary(self.bio_data, events)
+            return self._today
+
+    def set_convo_starter(self, key, value):
+        with self.lock:
+            self.convo_start_info[key] = value
+            self.store.record({"op": "set", "key": "convo_starter", "value": dict(self.convo_start_info)})
+
+    def pop_greeting(self):
+        # Next pre-generated greeting, or None if the pool is empty
+        with self.lock:
+            greetings = self.convo_start_info.get("greetings") or []
+            if not greetings:
+                return None
+            self.set_convo_starter("greetings", greetings[1:])
+            return greetings[0]
 
     def get_basic_info(self, field):
         # Return basic information
@@ -50,7 +124,7 @@ class Memory:
         return today.strftime("%d/%m/%Y")  # "25/03/2025"
 
     # Retrieving data
-    def _generate_keys(self, contextualized_query)->List[str]:
+    def _generate_keys(self, contextualized_query, spent=None)->List[str]:
         # Generate keys to search through knowledge base
         """
         LLM output should be in the format 
@@ -58,50 +132,58 @@ class Memory:
         top_level,search_terms...
         * as many as it likes
         <\\keys>
+        spent: speculative call (prefetch), made at background priority, its tokens get appended to this list
         """
+        priority, prefix = (PRIORITY_REPLY, "") if spent is None else (PRIORITY_BACKGROUND, SPECULATIVE_PREFIX)
         # Send query+context, and list of top level fields
-        prompt = f"""
-        Here is the context + query:{contextualized_query}
-        Here are the top level fields in my knowledge base:{' '.join(self.top_level_fields)}
-        I want you to select search keys from my knowledge base,
-        and return them in this format:
-        <keys>
-        top_level_field
-        ...
-        <\\keys>
-        1. Do not generate any text outside the <keys> 
-        2. Only generate top level fields
-        """
-        (_,resp,_) = self.llm.make_query(prompt, temp=0.2)
+        (in_tokens,resp,out_tokens) = self.llm.make_query(self._fields_prompt(contextualized_query), temp=0.2,
+                                                          priority=priority, stage=prefix + "key_generation_fields")
+        if spent is not None:
+            spent.append(in_tokens + out_tokens)
+        final_prompt = self._subfields_prompt(contextualized_query, resp)
+        if final_prompt is None:
+            return []
+        (in_tokens, resp, out_tokens) = self.llm.make_query(final_prompt, temp=0.2, priority=priority, stage=prefix + "key_generation_subfields")
+        if spent is not None:
+            spent.append(in_tokens + out_tokens)
+        return self._parse_keys(resp)
+
+    async def _generate_keys_async(self, contextualized_query):
+        # Same two calls as _generate_keys, without blocking the event loop
+        (_,resp,_) = await self.llm.make_query_async(self._fields_prompt(contextualized_query), temp=0.2, stage="key_generation_fields")
+        final_prompt = self._subfields_prompt(contextualized_query, resp)
+        if final_prompt is None:
+            return []
+        (_, resp,_) = await self.llm.make_query_async(final_prompt, temp=0.2, stage="key_generation_subfields")
+        return self._parse_keys(resp)
+
+    def _fields_prompt(self, contextualized_query):
+        return prompts.render("key_generation_fields", fields=" ".join(self.top_level_fields), query=contextualized_query)
+
+    def _subfields_prompt(self, contextualized_query, resp):
+        # Second prompt, built from the top level fields the first one picked. None if it didn't pick any
+        if resp is None:
+            return None
 
         # Extract text inside <keys>...</keys> using regex
         match = re.search(r"<keys>(.*?)</keys>", resp, re.DOTALL)
         
         if not match:
-            return []  # Return an empty list if no valid keys were found
+            return None  # No valid keys were found
 
         keys_content = match.group(1).strip()
         top_level_keys = keys_content.split("\n")
         rough_keys = []
-        for top_level_key in top_level_keys:
-            if top_level_key in self.field_data:
-                rough_keys.append(f"{top_level_key} | {list(self.data[top_level_key].keys())}")
-
-        final_prompt = f"""
-        Here is the context + query:{contextualized_query}
-        Now, I've chosen some fields from my knowledge base. I want you to select the subfields that seem relevant to you.
-        Here is a list of top_level_field | <chosen keys in top level field>:
-        {"\n".join(rough_keys)}
-        Return your output in the format:
-        <keys>
-        <name of a chosen top level field> | <chosen search term1>, <chosen term2> ....
-        ...
-        <\\keys>
-        1. DO NOT OUTPUT ANY TEXT OUTSIDE <keys>...<\\keys>
-        2. Retrieve less information for generic prompts. 
-        3. Only retrieve basic info when user specific query is asked(e.g. his birthday celebration)
-        """
-        (_, resp,_) = self.llm.make_query(final_prompt, temp=0.2)
+        with self.lock:
+            for top_level_key in top_level_keys:
+                if top_level_key in self.field_data:
+                    rough_keys.append(f"{top_level_key} | {self.field_names(top_level_key)}")
+
+        return prompts.render("key_generation_subfields", fields="\n".join(rough_keys), query=contextualized_query)
+
+    def _parse_keys(self, resp):
+        if resp is None:
+            return []
         # Extract text inside <keys>...</keys> using regex
         match1 = re.search(r"<keys>(.*?)<\\keys>", resp, re.DOTALL)
 
@@ -123,8 +205,34 @@ class Memory:
         
         return key_list
 
-    def retrieve(self, contextualized_query):
+    def field_names(self, domain):
+        # Field names of a domain, without loading its shard
+        with self.lock:
+            if self.sharded:
+                return list(self.store.outline.get(domain, []))
+            return list(self.data[domain].keys())
+
+    def _load_candidate_shards(self, contextualized_query):
+        # Make sure the domains most likely to hold the answer are resident before searching the facts
+        hits = self.domain_index.search(contextualized_query, top_k=self.store.max_resident)
+        for (domain, _), _ in reversed(hits):
+            # Worst first, so the best candidates end up most recently used
+            self.data[domain]
+
+    def _search_index(self, contextualized_query):
+        # Ranked top-k facts straight from the local index, no LLM involved
+        with self.lock:
+            if self.sharded:
+                self._load_candidate_shards(contextualized_query)
+            hits = self.index.search(contextualized_query, top_k=self.top_k)
+            return "\n".join(f"{domain}:{field}:{clip_fact(self.data[domain][field], self.max_fact_tokens)}" for (domain, field), _ in hits)
+
+    def retrieve(self, contextualized_query, spent=None):
         # I'll return a string with all the data
+        # spent: see _generate_keys, only "llm" mode spends tokens
+        if self.retrieval_mode == "index":
+            with metrics.stage("retrieval"):
+                return self._search_index(contextualized_query)
 
         # def search_misc(search_term, misc_data):
         #     # "misc.": [...set of strings] // for all the stuff that doesn't necessarily match with a key
@@ -134,57 +242,166 @@ class Memory:
         #             res.append(data_str)
         #     return res
             
+        return self.retrieve_by_keys(self._generate_keys(contextualized_query, spent))
+
+    async def retrieve_async(self, contextualized_query):
+        """
+        retrieve() for the async server: the LLM calls of "llm" mode are awaited (so they can be cancelled),
+        local work runs in a thread since it takes the memory lock and may load shards from disk
+        """
+        if self.retrieval_mode == "index":
+            return await asyncio.to_thread(self.retrieve, contextualized_query)
+        hierarchical_keys = await self._generate_keys_async(contextualized_query)
+        return await asyncio.to_thread(self.retrieve_by_keys, hierarchical_keys)
+
+    def retrieve_by_keys(self, hierarchical_keys):
+        # hierarchical_keys: [[top_level, search_term, ...], ...]
         recalled_data = []
-        hierarchical_keys = self._generate_keys(contextualized_query)
         # The first element of each sub-array is my top-level keys
-        for key_obj in hierarchical_keys:
-            top_level_key = key_obj[0]
-            if top_level_key in self.field_data:
-                data_obj = self.data[top_level_key]
-                # recalled_data.append(data_obj["general"]) # Essentials
-
-                if len(key_obj) > 1:
-                    # Actually has some search terms
-                    search_terms = key_obj[1:]
-                    recalled_data.extend([
-                        f"{top_level_key}:{term}:{data_obj[term]}"
-                        for term in search_terms
-                        if term in data_obj and data_obj[term] != ""
-                    ])
-                    # misc_extension = [search_misc(term, data_obj["misc."]) for term in search_terms]
-                    # if len(misc_extension) > 0:
-                    #     recalled_data.extend(misc_extension)
-                    
+        with self.lock:
+            for key_obj in hierarchical_keys:
+                top_level_key = key_obj[0]
+                if top_level_key in self.field_data:
+                    data_obj = self.data[top_level_key]
+                    # recalled_data.append(data_obj["general"]) # Essentials
+
+                    if len(key_obj) > 1:
+                        # Actually has some search terms
+                        search_terms = key_obj[1:]
+                        recalled_data.extend([
+                            f"{top_level_key}:{term}:{clip_fact(data_obj[term], self.max_fact_tokens)}"
+                            for term in search_terms
+                            if term in data_obj and data_obj[term] != ""
+                        ])
+                        # misc_extension = [search_misc(term, data_obj["misc."]) for term in search_terms]
+                        # if len(misc_extension) > 0:
+                        #     recalled_data.extend(misc_extension)
+
         return "\n".join(recalled_data)
     
+    def kb_outline(self):
+        """
+        Compact "domain: field, field, ..." listing of the whole KB, cached between turns
+        """
+        with self.lock:
+            if self._outline is None:
+                self._outline = "\n".join(f"{domain}: {','.join(self.field_names(domain))}" for domain in self.top_level_fields)
+            return self._outline
+
     # write to disk
-    def write_to_disk(self):
+    def _snapshot(self):
         permanent_info = { "volatility":"permanent"}
         permanent_info["fields_info"] = self.field_data
         permanent_info["bio_data"] = self.bio_data
         permanent_info["data"] = self.data
         permanent_info["convo_starter"] = self.convo_start_info
-        with open(self.disk_path, "w") as file:
-            json.dump(permanent_info, file, indent=4)
+        permanent_info["field_meta"] = self.field_meta
+        return permanent_info
+
+    def _backfill_meta(self, domain, fields):
+        # Fields from before size/age tracking: size from the value, age unknown (so as old as it gets)
+        known = self.field_meta.setdefault(domain, {})
+        for field, fact in fields.items():
+            if field not in known:
+                known[field] = {"created": 0, "updated": 0, "version": 1, "chars": len(fact)}
+
+    def _touch(self, top_level, sub_field, new_version=False, compacted=False):
+        # Size and age of the field, kept next to it so compaction knows what's worth looking at
+        now = time.time()
+        meta = self.field_meta.setdefault(top_level, {}).get(sub_field)
+        if meta is None:
+            meta = {"created": now, "version": 1}
+            self.field_meta[top_level][sub_field] = meta
+        elif new_version:
+            meta["version"] += 1
+        meta["chars"] = len(self.data[top_level][sub_field])
+        meta["updated"] = now
+        if compacted:
+            meta["compacted_chars"] = meta["chars"]
+        return dict(meta)
+
+    def _record_put(self, top_level, sub_field, new_version=False, compacted=False):
+        meta = self._touch(top_level, sub_field, new_version, compacted)
+        self.store.record({"op": "put", "domain": top_level, "field": sub_field,
+                           "value": self.data[top_level][sub_field], "count": self.field_data[top_level], "meta": meta})
+        if self.sharded:
+            self.domain_index.update(top_level, "", " ".join(self.store.outline[top_level]))
+
+    def write_to_disk(self):
+        # Appends only what changed since the last write, does nothing if nothing did
+        with self.lock, metrics.stage("disk_write"):
+            return self.store.commit(self._snapshot)
 
     def add_top_level_field(self, field_name, gen_string = ""):
         field_name = field_name.strip()
-        if field_name not in self.field_data:
-            self.field_data[field_name] = 1
-            self.data[field_name] = {"general":gen_string}
-            return 1 # Success
-        else:
-            self.data[field_name]["general"] += f"\n{gen_string}"
-            return 0 # already existed!
+        with self.lock:
+            if field_name not in self.field_data:
+                self.field_data[field_name] = 1
+                self.data[field_name] = {"general":gen_string}
+                self._outline = None
+                self.top_level_fields.append(field_name)
+                self.index.update(field_name, "general", gen_string)
+                self._record_put(field_name, "general")
+                return 1 # Success
+            else:
+                self.data[field_name]["general"] = merge_fragments(self.data[field_name]["general"], gen_string)
+                self.index.update(field_name, "general", self.data[field_name]["general"])
+                self._record_put(field_name, "general")
+                return 0 # already existed!
+
+    def remove_top_level_field(self, field_name):
+        """
+        Drops a whole domain: its facts, field count and meta. Returns False if there's no such domain
+        """
+        with self.lock:
+            if field_name not in self.field_data:
+                return False
+            fields = self.field_names(field_name)
+            del self.data[field_name]
+            self.index.remove_domain(field_name, fields)
+            if self.sharded:
+                self.domain_index.remove(field_name, "")
+            del self.field_data[field_name]
+            self.field_meta.pop(field_name, None)
+            self.top_level_fields.remove(field_name)
+            self._outline = None
+            self._today = None # in case it was the events domain
+            self.store.record({"op": "delete", "domain": field_name})
+            return True
 
     def change_subfield_and_fact(self, top_level, sub_field, new_fact_string, to_add=True):
-        # Add
-        if (sub_field not in self.data[top_level]) and to_add:
-            self.field_data[top_level] += 1
-            self.data[top_level][sub_field] = new_fact_string
-        elif (sub_field in self.data[top_level]) and to_add:
-            self.data[top_level][sub_field] += new_fact_string
-        else:
-            self.data[top_level][sub_field] = new_fact_string
-            
-        
+        with self.lock:
+            if sub_field not in self.data[top_level]:
+                self._outline = None
+            # Add
+            if (sub_field not in self.data[top_level]) and to_add:
+                self.field_data[top_level] += 1
+                self.data[top_level][sub_field] = new_fact_string
+            elif (sub_field in self.data[top_level]) and to_add:
+                self.data[top_level][sub_field] = merge_fragments(self.data[top_level][sub_field], new_fact_string)
+            else:
+                self.data[top_level][sub_field] = new_fact_string
+            self.index.update(top_level, sub_field, self.data[top_level][sub_field])
+            self._record_put(top_level, sub_field)
+
+    def mark_compacted(self, top_level, sub_field):
+        with self.lock:
+            meta = self.field_meta.get(top_level, {}).get(sub_field)
+            if meta is not None:
+                meta["compacted_chars"] = meta["chars"]
+
+    def replace_compacted(self, top_level, sub_field, old_value, new_value):
+        """
+        Swaps in a compacted version of a field, archiving the old one to the history file.
+        Does nothing (returns False) if the field changed since old_value was read.
+        """
+        with self.lock:
+            if self.data[top_level].get(sub_field) != old_value:
+                return False
+            meta = self.field_meta.get(top_level, {}).get(sub_field, {})
+            self.store.append_history({"ts": time.time(), "domain": top_level, "field": sub_field,
+                                       "version": meta.get("version", 1), "value": old_value})
+            self.data[top_level][sub_field] = new_value
+            self.index.update(top_level, sub_field, new_value)
+            self._record_put(top_level, sub_field, new_version=True, compacted=True)
+            return True
@@ -0,0 +1,207 @@
+from collections import defaultdict, namedtuple
+import json
+import os
+import threading
+import time
+
+# Calls are tagged with a stage, a few stages share a route
+STAGE_ALIASES = {"key_generation_fields": "key_generation", "key_generation_subfields": "key_generation"}
+# Speculative calls (prefetch while the user types) are tagged with this in front of the stage they run ahead of
+SPECULATIVE_PREFIX = "prefetch_"
+
+SMALL_MODEL = "llama3-8b-8192"
+
+# model None means the agent's own model (Conversationalist's model argument).
+# temperature None means whatever the caller asked for. slow_after is in seconds.
+DEFAULT_ROUTES = {
+    "reply": {"model": None, "fallback": SMALL_MODEL, "max_tokens": 1024, "slow_after": 6.0},
+    "greeting": {"model": None, "fallback": SMALL_MODEL, "max_tokens": 200, "slow_after": 4.0},
+    "context_extraction": {"model": SMALL_MODEL, "fallback": "gemma2-9b-it", "max_tokens": 300},
+    "key_generation": {"model": SMALL_MODEL, "fallback": "gemma2-9b-it", "max_tokens": 200},
+    "planner": {"model": SMALL_MODEL, "fallback": "gemma2-9b-it", "max_tokens": 400},
+    "context_summary": {"model": SMALL_MODEL, "max_tokens": 300},
+    "learning": {"model": None, "fallback": SMALL_MODEL, "max_tokens": 600, "slow_after": 15.0},
+    "fact_merge": {"model": None, "fallback": SMALL_MODEL, "max_tokens": 400, "slow_after": 15.0},
+    "fact_compaction": {"model": SMALL_MODEL, "max_tokens": 300},
+    "default": {"model": None}
+}
+
+# USD per million (input, output) tokens
+DEFAULT_PRICES = {
+    "llama3-70b-8192": (0.59, 0.79),
+    "llama3-8b-8192": (0.05, 0.08),
+    "gemma2-9b-it": (0.20, 0.20)
+}
+
+# What Groq_Agent gets for one call
+Choice = namedtuple("Choice", ["route", "model", "temperature", "max_tokens", "is_fallback"])
+
+
+class Route:
+    def __init__(self, name, model=None, fallback=None, temperature=None, max_tokens=None, slow_after=8.0):
+        self.name = name
+        self.model = model
+        self.fallback = fallback
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.slow_after = slow_after
+        self.latency_ewma = None # recent latency of the primary model
+        self.first_token_ewma = None # same for streamed calls, up to their first token
+        self.degraded_until = 0.0 # primary is skipped until then
+
+
+class ModelRouter:
+    """
+    Picks the model, temperature and max_tokens for every LLM call from its stage.
+    Routes come from DEFAULT_ROUTES, overridden by a JSON config:
+        {"routes": {"reply": {"model": "...", "fallback": "...", "max_tokens": 800}, ...},
+         "prices": {"model": [input, output]}, "cooldown": 60}
+    When the primary model of a route gets slow (moving average over slow_after seconds) or fails with
+    a retryable error or timeout, the route switches to its fallback for cooldown seconds, then tries the primary again.
+    Streamed calls are judged on their time to first token, a long reply isn't a slow model.
+    Calls, failures, latency, tokens and cost are tracked per (route, model).
+    """
+    def __init__(self, routes=None, prices=None, cooldown=60.0, alpha=0.3):
+        self.routes = {}
+        routes = routes or {}
+        for name in {**DEFAULT_ROUTES, **routes}:
+            # A configured route only has to list what it changes
+            self.routes[name] = Route(name, **{**DEFAULT_ROUTES.get(name, {}), **routes.get(name, {})})
+        self.prices = {**DEFAULT_PRICES, **{model: tuple(price) for model, price in (prices or {}).items()}}
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int) # (route, model) -> count
+        self.failures = defaultdict(int)
+        self.latency_total = defaultdict(float)
+        self.input_tokens = defaultdict(int)
+        self.output_tokens = defaultdict(int)
+        self.cost = defaultdict(float)
+        self.fallbacks = defaultdict(int) # route -> times it switched to its fallback
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r") as file:
+            config = json.load(file)
+        return cls(config.get("routes"), config.get("prices"), config.get("cooldown", 60.0))
+
+    def route(self, stage):
+        if stage.startswith(SPECULATIVE_PREFIX):
+            stage = stage[len(SPECULATIVE_PREFIX):]
+        stage = STAGE_ALIASES.get(stage, stage)
+        return self.routes.get(stage, self.routes["default"])
+
+    def pick(self, stage, default_model):
+        route = self.route(stage)
+        with self.lock:
+            degraded = route.fallback is not None and time.monotonic() < route.degraded_until
+        model = route.fallback if degraded else (route.model or default_model)
+        return Choice(route.name, model, route.temperature, route.max_tokens, degraded)
+
+    def _degrade(self, route):
+        # Called with self.lock held
+        if route.fallback is not None and time.monotonic() >= route.degraded_until:
+            route.degraded_until = time.monotonic() + self.cooldown
+            route.latency_ewma = None # the primary gets a fresh start once the cooldown is over
+            route.first_token_ewma = None
+            self.fallbacks[route.name] += 1
+
+    def note_error(self, choice):
+        """
+        A retryable error on the primary model, switch the route over before the retry
+        """
+        if choice.is_fallback:
+            return
+        with self.lock:
+            self._degrade(self.routes[choice.route])
+
+    def _average(self, previous, latency):
+        return latency if previous is None else self.alpha * latency + (1 - self.alpha) * previous
+
+    def observe(self, choice, latency, input_tokens, output_tokens, failed, retryable=False, first_token=None):
+        """
+        Records one finished call. retryable: it failed on a rate limit, server error or timeout,
+        anything else (bad request, auth...) is the caller's problem and doesn't switch the route.
+        first_token: seconds to the first token of a streamed call
+        """
+        key = (choice.route, choice.model)
+        price_in, price_out = self.prices.get(choice.model, (0.0, 0.0))
+        with self.lock:
+            self.calls[key] += 1
+            self.latency_total[key] += latency
+            self.input_tokens[key] += input_tokens
+            self.output_tokens[key] += output_tokens
+            self.cost[key] += (input_tokens * price_in + output_tokens * price_out) / 1e6
+            if failed:
+                self.failures[key] += 1
+            if choice.is_fallback:
+                return
+            route = self.routes[choice.route]
+            if failed:
+                if retryable:
+                    self._degrade(route)
+                return
+            if first_token is not None:
+                route.first_token_ewma = self._average(route.first_token_ewma, first_token)
+                slow = route.first_token_ewma > route.slow_after
+            else:
+                route.latency_ewma = self._average(route.latency_ewma, latency)
+                slow = route.latency_ewma > route.slow_after
+            if slow:
+                self._degrade(route)
+
+    def stats(self):
+        """
+        {route: {model: {calls, failures, avg_latency, input_tokens, output_tokens, cost_usd}}}
+        """
+        result = defaultdict(dict)
+        with self.lock:
+            for (route, model), calls in self.calls.items():
+                key = (route, model)
+                result[route][model] = {
+                    "calls": calls,
+                    "failures": self.failures[key],
+                    "avg_latency": round(self.latency_total[key] / calls, 4),
+                    "input_tokens": self.input_tokens[key],
+                    "output_tokens": self.output_tokens[key],
+                    "cost_usd": round(self.cost[key], 6)
+                }
+        return dict(result)
+
+    def render(self, prefix="him"):
+        """
+        Prometheus text exposition format, appended to the /metrics output
+        """
+        lines = []
+        with self.lock:
+            for name, values in (("route_calls_total", self.calls), ("route_failures_total", self.failures),
+                                 ("route_latency_seconds_sum", self.latency_total),
+                                 ("route_input_tokens_total", self.input_tokens), ("route_output_tokens_total", self.output_tokens),
+                                 ("route_cost_usd_total", self.cost)):
+                lines.append(f"# TYPE {prefix}_{name} counter")
+                for (route, model), value in sorted(values.items()):
+                    lines.append(f'{prefix}_{name}{{route="{route}",model="{model}"}} {value}')
+            lines.append(f"# TYPE {prefix}_route_fallbacks_total counter")
+            for route, value in sorted(self.fallbacks.items()):
+                lines.append(f'{prefix}_route_fallbacks_total{{route="{route}"}} {value}')
+            lines.append(f"# TYPE {prefix}_route_degraded gauge")
+            now = time.monotonic()
+            for name, route in sorted(self.routes.items()):
+                lines.append(f'{prefix}_route_degraded{{route="{name}"}} {int(now < route.degraded_until)}')
+        return "\n".join(lines) + "\n"
+
+
+_shared_router = None
+_shared_router_lock = threading.Lock()
+
+def shared_router():
+    """
+    Process-wide router, so latency and cost are tracked across every session.
+    Reads the routes from the file in HIM_ROUTES if set.
+    """
+    global _shared_router
+    with _shared_router_lock:
+        if _shared_router is None:
+            path = os.getenv("HIM_ROUTES")
+            _shared_router = ModelRouter.from_file(path) if path else ModelRouter()
+        return _shared_router
@@ -1,27 +1,88 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-from processing_module import Conversationalist
+from session_module import SessionPool, valid_user_id
+from metrics_module import metrics
+from routing_module import shared_router
+from prompt_module import prompts
+import atexit
 import os
+import json
+import signal
+import sys
 from dotenv import load_dotenv
 
 load_dotenv()  # Load environment variables from .env
 
 groq_key = os.getenv("GROQ_API_KEY")
-model = "gemma2-9b-it"
-talker = Conversationalist(groq_api_key=groq_key)
-# talker = Conversationalist()
+# Models per stage come from the routing config (HIM_ROUTES, see routing_module.py)
+# One Conversationalist per session, Memory per user, both created on first use
+pool = SessionPool(groq_key, max_sessions=int(os.getenv("MAX_SESSIONS", "32")))
+# Learning is batched in the background, so pending turns are only on disk once their session closes:
+# finish them (and write every user's Memory) when the server stops
+atexit.register(pool.close_all)
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+def session_ids(data):
+    # Session/user ids can come in the body or as headers, everything else falls back to the single default user
+    session_id = data.get("session_id") or request.headers.get("X-Session-Id", "default")
+    user_id = data.get("user_id") or request.headers.get("X-User-Id", "default")
+    return str(session_id), str(user_id)
+
 @app.route('/chat', methods=['POST'])
 def chat():
     data = request.get_json()
     if not data or 'message' not in data:
         return jsonify({'error': 'Missing message'}), 400
     
-    response = talker.process_query(data["message"])
+    session_id, user_id = session_ids(data)
+    if not valid_user_id(user_id):
+        return jsonify({'error': 'Invalid user id'}), 400
+    with pool.session(session_id, user_id) as talker:
+        response = talker.process_query(data["message"])
     return jsonify({'response': response})
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    # Server-sent events: one "data:" event per chunk of the reply, then a "done" event
+    data = request.get_json()
+    if not data or 'message' not in data:
+        return jsonify({'error': 'Missing message'}), 400
+
+    session_id, user_id = session_ids(data)
+    if not valid_user_id(user_id):
+        return jsonify({'error': 'Invalid user id'}), 400
+
+    def events():
+        with pool.session(session_id, user_id) as talker:
+            for chunk in talker.process_query_stream(data["message"]):
+                yield f"data: {json.dumps({'token': chunk})}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/prefetch', methods=['POST'])
+def prefetch():
+    # Draft of the message being typed, so the turn can skip retrieval if it's sent as is (or close to it).
+    # Doesn't wait for the session: speculation runs on its own worker
+    data = request.get_json()
+    if not data or 'message' not in data:
+        return jsonify({'error': 'Missing message'}), 400
+
+    session_id, user_id = session_ids(data)
+    if not valid_user_id(user_id):
+        return jsonify({'error': 'Invalid user id'}), 400
+    started = pool.get(session_id, user_id).talker.prefetch(str(data["message"]))
+    return jsonify({'started': started}), 202
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # Per-stage latency histograms, token and failure counters, calls/latency/cost per model route, per-prompt tokens and prefix reuse
+    return Response(metrics.render() + shared_router().render() + prompts.render_metrics(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # SIGTERM (e.g. a container stopping) exits normally, so the atexit hook above still runs
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    app.run(debug=True, threaded=True)
\ No newline at end of file
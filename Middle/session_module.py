@@ -0,0 +1,199 @@
+from processing_module import Conversationalist
+from retrieval_module import Memory
+from groq_interface import Groq_Agent
+from cache_module import ResponseCache
+from storage_module import create_kb, sharded_kb_dir
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+import asyncio
+import re
+import threading
+import time
+import os
+
+# User ids end up in a path on disk, so they're limited to a safe alphabet
+USER_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+def valid_user_id(user_id):
+    return USER_ID_PATTERN.fullmatch(user_id) is not None
+
+
+class Session:
+    def __init__(self, session_id, user_id, talker: Conversationalist):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.talker = talker
+        self.lock = threading.Lock() # one request at a time per session
+        self.async_lock = asyncio.Lock() # async server: requests of the session queue up here instead of blocking a thread
+        self.last_used = time.time()
+        self.closed = False
+
+
+class SessionPool:
+    """
+    Bounded pool of Conversationalist objects keyed by (user id, session id), so two users that send the same
+    (or the default) session id never share a conversation or a KB.
+    Requests of the same session are serialized, different sessions run in parallel.
+    The LLM interface and Memory are per user, loaded the first time one of the user's sessions needs them,
+    and shared between that user's sessions.
+    When the pool is full, the least recently used idle session is evicted.
+    """
+    def __init__(self, groq_api_key, max_sessions=32, kb_dir="KB", model="llama3-70b-8192", retrieval_mode="index", use_cache=False):
+        self.groq_api_key = groq_api_key
+        self.max_sessions = max_sessions
+        self.kb_dir = kb_dir
+        self.model = model
+        self.retrieval_mode = retrieval_mode
+        self.cache = ResponseCache() if use_cache else None # safe to share, keys include the language
+        self.sessions = OrderedDict() # (user_id, session_id) -> Session, least recently used first
+        self.users = {} # user_id -> (llm, memory, number of live sessions)
+        self.lock = threading.Lock()
+        # Evicted sessions finish their pending learning and end of convo job here, not on the request that evicted them
+        self.closer = ThreadPoolExecutor(max_workers=1)
+
+    def kb_path(self, user_id):
+        # The default user keeps the original single-user KB location
+        if user_id == "default":
+            return os.path.join(self.kb_dir, "permanent.json")
+        return os.path.join(self.kb_dir, "users", user_id, "permanent.json")
+
+    def _user_resources(self, user_id):
+        # Called with self.lock held
+        if user_id not in self.users:
+            path = self.kb_path(user_id)
+            if not os.path.exists(path) and sharded_kb_dir(path) is None:
+                # First time we see this user
+                create_kb(path)
+            llm = Groq_Agent(self.groq_api_key, model=self.model, cache=self.cache)
+            memory = Memory(llm, path_to_permanent_data=path, retrieval_mode=self.retrieval_mode)
+            self.users[user_id] = (llm, memory, 0)
+        llm, memory, live = self.users[user_id]
+        self.users[user_id] = (llm, memory, live + 1)
+        return llm, memory
+
+    def _release_user(self, user_id):
+        # Called with self.lock held
+        llm, memory, live = self.users[user_id]
+        self.users[user_id] = (llm, memory, live - 1)
+
+    def get(self, session_id, user_id="default") -> Session:
+        if not valid_user_id(user_id):
+            raise ValueError(f"Invalid user id: {user_id!r}")
+        evicted = []
+        key = (user_id, session_id)
+        with self.lock:
+            if key in self.sessions:
+                self.sessions.move_to_end(key)
+                session = self.sessions[key]
+            else:
+                llm, memory = self._user_resources(user_id)
+                session = Session(session_id, user_id, Conversationalist(llm=llm, memory=memory))
+                self.sessions[key] = session
+                evicted = self._evict_idle()
+            session.last_used = time.time()
+        # Closing waits for pending learning (and LLM calls), don't hold up this request or the rest of the pool for that
+        for old_session in evicted:
+            try:
+                self.closer.submit(self._close_session, old_session)
+            except RuntimeError: # the pool is shutting down
+                self._close_session(old_session)
+        return session
+
+    def _evict_idle(self):
+        # Called with self.lock held. Busy sessions (lock held) are skipped, so the pool can
+        # briefly go over max_sessions when everyone is mid-request
+        evicted = []
+        for key in list(self.sessions.keys()):
+            if len(self.sessions) <= self.max_sessions:
+                break
+            session = self.sessions[key]
+            if session.lock.locked():
+                continue
+            del self.sessions[key]
+            self._release_user(session.user_id)
+            evicted.append(session)
+        return evicted
+
+    def _close_session(self, session):
+        with session.lock:
+            session.closed = True
+            session.talker.close()
+        # Only drop the user's Memory once their pending learning is done and nobody picked it back up,
+        # otherwise a fresh copy could be loaded from disk before this one's writes land
+        with self.lock:
+            user = self.users.get(session.user_id)
+            if user is not None and user[2] <= 0:
+                del self.users[session.user_id]
+                user[1].write_to_disk()
+
+    @contextmanager
+    def session(self, session_id, user_id="default"):
+        """
+        with pool.session(sid, uid) as talker: ... runs with the session's lock held
+        """
+        while True:
+            session = self.get(session_id, user_id)
+            session.lock.acquire()
+            if not session.closed:
+                break
+            # Got evicted between get() and here, start a fresh one
+            session.lock.release()
+        try:
+            session.last_used = time.time()
+            yield session.talker
+        finally:
+            session.lock.release()
+
+    @asynccontextmanager
+    async def session_async(self, session_id, user_id="default"):
+        """
+        async with pool.session_async(sid, uid) as talker: ... for the async server.
+        Loading a user and evicting sessions block, so they run in a thread.
+        """
+        while True:
+            session = await asyncio.to_thread(self.get, session_id, user_id)
+            await session.async_lock.acquire()
+            # Normally free, since async requests of the session are serialized by async_lock.
+            # Taken means it's being closed (evicted), so start over with a fresh one
+            if session.lock.acquire(blocking=False):
+                if not session.closed:
+                    break
+                session.lock.release()
+            session.async_lock.release()
+            await asyncio.sleep(0.01)
+        try:
+            session.last_used = time.time()
+            yield session.talker
+        finally:
+            session.lock.release()
+            session.async_lock.release()
+
+    def close_all(self, wrap_up_seconds=20.0):
+        """
+        Shutdown: pending learning of every session goes into Memory and onto disk first,
+        so being killed during the slower end of convo jobs (summary + greetings, 2 LLM calls per session)
+        loses nothing that was learned. Those only run until wrap_up_seconds are up, later sessions skip them.
+        """
+        self.closer.shutdown(wait=True) # evictions still closing
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+            memories = [memory for (_, memory, _) in self.users.values()]
+            self.users.clear()
+        for session in sessions:
+            session.lock.acquire()
+            session.closed = True
+            session.talker.flush_learning(wait=False) # every session's half-full batch gets going at once
+        for session in sessions:
+            session.talker.flush_learning()
+        for memory in memories:
+            memory.write_to_disk()
+        deadline = time.monotonic() + wrap_up_seconds
+        for session in sessions:
+            try:
+                session.talker.close(wrap_up=time.monotonic() < deadline)
+            finally:
+                session.lock.release()
+        for memory in memories:
+            memory.write_to_disk()
@@ -0,0 +1,335 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import hashlib
+import json
+import os
+import re
+import threading
+
+def apply_op(state, op):
+    """
+    Applies one logged mutation to the in-memory KB dict.
+    Ops carry the resulting value rather than the change, so replaying one twice is harmless.
+    """
+    if op["op"] == "put":
+        state["data"].setdefault(op["domain"], {})[op["field"]] = op["value"]
+        state["fields_info"][op["domain"]] = op["count"]
+        if "meta" in op:
+            state.setdefault("field_meta", {}).setdefault(op["domain"], {})[op["field"]] = op["meta"]
+    elif op["op"] == "set":
+        state[op["key"]] = op["value"]
+    elif op["op"] == "delete":
+        # A whole top-level domain
+        if op["domain"] in state["data"]:
+            del state["data"][op["domain"]]
+        state["fields_info"].pop(op["domain"], None)
+        state.get("field_meta", {}).pop(op["domain"], None)
+
+
+class JournaledStore:
+    """
+    Snapshot + write-ahead log persistence for the KB.
+    Every commit only appends the mutations since the last commit to <snapshot>.wal,
+    once enough of them pile up the snapshot is rewritten (atomically) and the log is cleared.
+    """
+    def __init__(self, snapshot_path, compact_every=200):
+        self.snapshot_path = snapshot_path
+        self.log_path = snapshot_path + ".wal"
+        self.history_path = snapshot_path + ".history.jsonl" # old versions of compacted fields
+        self.compact_every = compact_every
+        self.pending = [] # mutations that haven't hit the disk yet
+        self.logged_ops = 0 # mutations in the log since the last snapshot
+
+    def load(self):
+        # Snapshot first, then replay whatever made it into the log after it
+        with open(self.snapshot_path, "r") as file:
+            state = json.load(file)
+        self.logged_ops = 0
+        if os.path.exists(self.log_path):
+            good_end = 0 # offset just past the last complete op
+            torn = False
+            with open(self.log_path, "rb") as log:
+                for line in log:
+                    # Every op is written with its newline, a line without one never finished
+                    try:
+                        op = json.loads(line) if line.endswith(b"\n") else None
+                    except json.JSONDecodeError:
+                        op = None
+                    if op is None:
+                        torn = True
+                        break
+                    apply_op(state, op)
+                    self.logged_ops += 1
+                    good_end += len(line)
+            if torn:
+                # Torn write from a crash: everything after it is lost anyway, and it has to go,
+                # or the next commit would append onto the partial line and be unreadable itself
+                with open(self.log_path, "r+b") as log:
+                    log.truncate(good_end)
+                    log.flush()
+                    os.fsync(log.fileno())
+        return state
+
+    def record(self, op):
+        self.pending.append(op)
+
+    def append_history(self, record):
+        # Append-only, nothing ever reads it back at runtime
+        with open(self.history_path, "a") as history:
+            history.write(json.dumps(record) + "\n")
+            history.flush()
+            os.fsync(history.fileno())
+
+    def is_dirty(self):
+        return len(self.pending) > 0
+
+    def commit(self, get_state):
+        """
+        Appends pending mutations to the log, compacting if the log got long.
+        get_state is only called when compacting. Returns False if there was nothing to write.
+        """
+        if not self.pending:
+            return False
+        with open(self.log_path, "a") as log:
+            log.write("".join(json.dumps(op) + "\n" for op in self.pending))
+            log.flush()
+            os.fsync(log.fileno())
+        self.logged_ops += len(self.pending)
+        self.pending = []
+        if self.logged_ops >= self.compact_every:
+            self.compact(get_state())
+        return True
+
+    def compact(self, state):
+        # Write the new snapshot next to the old one and swap it in, so a crash never leaves half a file
+        _atomic_write_json(self.snapshot_path, state, indent=4)
+        # Only now is it safe to drop the log (replaying it over the new snapshot would be harmless too)
+        open(self.log_path, "w").close()
+        self.logged_ops = 0
+
+
+def empty_kb():
+    # A KB with nothing learned yet, in the KB/permanent.json schema
+    return {
+        "data": {},
+        "bio_data": {"name": "", "preferred_lang": "English", "alt_langs": []},
+        "fields_info": {},
+        "convo_starter": {"general_info": "", "prev_context": ""},
+        "field_meta": {}
+    }
+
+def create_kb(path):
+    """
+    Writes an empty KB to path, for a user that doesn't have one yet
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    _atomic_write_json(path, empty_kb(), indent=4)
+
+
+def sharded_kb_dir(path):
+    """
+    Returns the directory of a sharded KB for path, or None if path is a single-file KB.
+    "KB/permanent.json" resolves to "KB/permanent/" once it has been migrated.
+    """
+    if os.path.isdir(path):
+        return path
+    base = os.path.splitext(path)[0]
+    if not os.path.exists(path) and os.path.isfile(os.path.join(base, "manifest.json")):
+        return base
+    return None
+
+
+class LazyShards(MutableMapping):
+    """
+    The KB's data dict, one shard per top-level domain, loaded from disk on first access.
+    At most max_resident shards stay in memory, the least recently used one is evicted first
+    (and written out first if it has unsaved changes).
+    on_load(domain, fields) / on_evict(domain, fields) let Memory keep its index in step.
+    """
+    def __init__(self, store, max_resident=16):
+        self.store = store
+        self.max_resident = max_resident
+        self.resident = OrderedDict()
+        self.on_load = None
+        self.on_evict = None
+        self.lock = threading.RLock()
+
+    def __getitem__(self, domain):
+        with self.lock:
+            if domain in self.resident:
+                self.resident.move_to_end(domain)
+                return self.resident[domain]
+            if domain not in self.store.shard_files:
+                raise KeyError(domain)
+            fields = self.store.read_shard(domain)
+            self._admit(domain, fields)
+            return fields
+
+    def __setitem__(self, domain, fields):
+        with self.lock:
+            if domain not in self.store.shard_files:
+                self.store.shard_files[domain] = self.store.shard_name(domain)
+                self.store.outline[domain] = list(fields.keys())
+            if domain in self.resident and self.on_evict is not None:
+                self.on_evict(domain, self.resident[domain])
+            self.store.dirty.add(domain)
+            self._admit(domain, fields)
+
+    def __delitem__(self, domain):
+        # The shard file itself is removed at the next compaction, once the manifest no longer points at it
+        with self.lock:
+            if domain not in self.store.shard_files:
+                raise KeyError(domain)
+            fields = self.resident.pop(domain, None)
+            if fields is not None and self.on_evict is not None:
+                self.on_evict(domain, fields)
+            self.store.removed_files.append(self.store.shard_files.pop(domain))
+            self.store.outline.pop(domain, None)
+            self.store.dirty.discard(domain)
+
+    def __iter__(self):
+        return iter(list(self.store.shard_files))
+
+    def __len__(self):
+        return len(self.store.shard_files)
+
+    def __contains__(self, domain):
+        return domain in self.store.shard_files
+
+    def _admit(self, domain, fields):
+        self.resident[domain] = fields
+        self.resident.move_to_end(domain)
+        if self.on_load is not None:
+            self.on_load(domain, fields)
+        while len(self.resident) > self.max_resident:
+            old_domain, old_fields = self.resident.popitem(last=False)
+            if old_domain in self.store.dirty:
+                self.store.write_shard(old_domain, old_fields)
+                self.store.dirty.discard(old_domain)
+            if self.on_evict is not None:
+                self.on_evict(old_domain, old_fields)
+
+
+class ShardedStore(JournaledStore):
+    """
+    Same write-ahead log as JournaledStore, but the snapshot is split up:
+        <dir>/manifest.json     fields_info, bio_data, convo_starter, field_meta, field names per domain, shard file names
+        <dir>/shards/<x>.json   one file per top-level domain
+    Startup only reads the manifest (and replays the log), domains are loaded when they're first touched.
+    Compaction rewrites the manifest and only the shards that changed.
+    """
+    def __init__(self, directory, compact_every=200, max_resident=16):
+        super().__init__(os.path.join(directory, "manifest.json"), compact_every)
+        self.directory = directory
+        self.history_path = os.path.join(directory, "history.jsonl")
+        self.max_resident = max_resident
+        self.shard_files = {} # domain -> file name inside shards/
+        self.outline = {} # domain -> field names, so the whole KB can be described without loading it
+        self.dirty = set() # domains with changes that aren't in their shard file yet
+        self.removed_files = [] # shards of deleted domains, still on disk until the next compaction
+        self.state = None
+
+    def shard_name(self, domain):
+        safe = re.sub(r"[^A-Za-z0-9_-]", "_", domain)[:40]
+        return f"{safe}-{hashlib.sha1(domain.encode('utf-8')).hexdigest()[:8]}.json"
+
+    def read_shard(self, domain):
+        with open(os.path.join(self.directory, "shards", self.shard_files[domain]), "r") as file:
+            return json.load(file)
+
+    def write_shard(self, domain, fields):
+        _atomic_write_json(os.path.join(self.directory, "shards", self.shard_files[domain]), fields)
+
+    def load(self):
+        with open(self.snapshot_path, "r") as file:
+            state = json.load(file)
+        self.shard_files = state.pop("shards")
+        self.outline = state.pop("outline")
+        self.dirty = set()
+        self.pending = []
+        state["data"] = LazyShards(self, self.max_resident)
+        self.state = state
+
+        replayed = 0
+        torn = False
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "rb") as log:
+                for line in log:
+                    try:
+                        op = json.loads(line) if line.endswith(b"\n") else None
+                    except json.JSONDecodeError:
+                        op = None
+                    if op is None:
+                        # Torn write from a crash, everything after it is lost anyway
+                        torn = True
+                        break
+                    self._apply(op)
+                    replayed += 1
+        self.logged_ops = replayed
+        if replayed or torn:
+            # Fold the log into the touched shards right away, so it doesn't keep growing across restarts.
+            # This also clears a torn tail, which the next commit would otherwise append onto
+            self.compact(state)
+        return state
+
+    def _apply(self, op):
+        apply_op(self.state, op)
+        self._track(op)
+
+    def _track(self, op):
+        if op["op"] == "put":
+            self.dirty.add(op["domain"])
+            fields = self.outline.setdefault(op["domain"], [])
+            if op["field"] not in fields:
+                fields.append(op["field"])
+
+    def record(self, op):
+        self.pending.append(op)
+        self._track(op)
+
+    def compact(self, state):
+        # Shards first, then the manifest that points at them, then the log
+        data = state["data"]
+        with data.lock:
+            for domain in list(self.dirty):
+                if domain in data.resident:
+                    self.write_shard(domain, data.resident[domain])
+            self.dirty = set()
+        manifest = {key: value for key, value in state.items() if key != "data"}
+        manifest["shards"] = self.shard_files
+        manifest["outline"] = self.outline
+        _atomic_write_json(self.snapshot_path, manifest)
+        # A domain that was deleted and added again gets its old file name back, that one stays
+        live = set(self.shard_files.values())
+        for name in self.removed_files:
+            if name not in live and os.path.exists(os.path.join(self.directory, "shards", name)):
+                os.remove(os.path.join(self.directory, "shards", name))
+        self.removed_files = []
+        open(self.log_path, "w").close()
+        self.logged_ops = 0
+
+    @staticmethod
+    def create(directory, state):
+        """
+        Writes a full single-file KB state out as a sharded KB (used by migrate_kb.py)
+        """
+        store = ShardedStore(directory)
+        os.makedirs(os.path.join(directory, "shards"), exist_ok=True)
+        for domain, fields in state["data"].items():
+            store.shard_files[domain] = store.shard_name(domain)
+            store.outline[domain] = list(fields.keys())
+            store.write_shard(domain, fields)
+        manifest = {key: value for key, value in state.items() if key != "data"}
+        manifest["shards"] = store.shard_files
+        manifest["outline"] = store.outline
+        _atomic_write_json(store.snapshot_path, manifest)
+        return store
+
+
+def _atomic_write_json(path, obj, indent=None):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(obj, file, indent=indent)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
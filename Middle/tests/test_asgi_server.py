@@ -0,0 +1,32 @@
+"""
+AdmissionQueue: free slots are taken straight away, only requests that have to queue count against max_waiting.
+"""
+from asgi_server import AdmissionQueue, Rejected
+import asyncio
+
+
+async def admit_all(queue, count, hold=0.1):
+    async def turn():
+        try:
+            await queue.acquire()
+        except Rejected as e:
+            return e.status
+        await asyncio.sleep(hold)
+        queue.release(hold)
+        return 200
+    return await asyncio.gather(*(turn() for _ in range(count)))
+
+def test_free_slots_are_not_counted_as_waiting():
+    async def run():
+        return await admit_all(AdmissionQueue(max_concurrent=4, max_waiting=2), 6)
+    assert sorted(asyncio.run(run())) == [200] * 6
+
+def test_no_waiting_room_still_fills_the_free_slots():
+    async def run():
+        return await admit_all(AdmissionQueue(max_concurrent=2, max_waiting=0), 3)
+    assert sorted(asyncio.run(run())) == [200, 200, 429]
+
+def test_rejects_beyond_the_waiting_limit():
+    async def run():
+        return await admit_all(AdmissionQueue(max_concurrent=4, max_waiting=2), 8)
+    assert sorted(asyncio.run(run())) == [200] * 6 + [429] * 2
@@ -0,0 +1,193 @@
+"""
+Groq_Agent against a local stub of the chat completions endpoint: retries, Retry-After,
+failing fast on client errors, and the rate limiter's priority lanes.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cache_module import ResponseCache
+from groq_interface import Groq_Agent, DEFAULT_SYSTEM_PROMPT
+from rate_limit_module import RateLimiter, PRIORITY_REPLY, PRIORITY_BACKGROUND
+from routing_module import ModelRouter
+import asyncio
+import json
+import threading
+import time
+import pytest
+
+
+class StubServer:
+    """
+    Answers POSTs with the scripted (status, headers) responses in order, then with 200s.
+    Records when each request came in.
+    """
+    def __init__(self, script=()):
+        self.script = list(script)
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                stub.requests.append(time.monotonic())
+                status, headers = stub.script.pop(0) if stub.script else (200, {})
+                if status != 200:
+                    self.send(status, {"error": {"message": "scripted failure", "type": "test"}}, headers)
+                elif body.get("stream"):
+                    self.stream(body["model"])
+                else:
+                    self.send(200, {"id": "x", "object": "chat.completion", "created": 0, "model": body["model"],
+                                    "choices": [{"index": 0, "finish_reason": "stop",
+                                                 "message": {"role": "assistant", "content": "hello there"}}],
+                                    "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12}})
+
+            def send(self, status, obj, headers=None):
+                data = json.dumps(obj).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def stream(self, model):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                events = [{"id": "x", "object": "chat.completion.chunk", "created": 0, "model": model,
+                           "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+                          for word in ("hello ", "there")]
+                for event in [json.dumps(event) for event in events] + ["[DONE]"]:
+                    data = f"data: {event}\n\n".encode()
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.write(b"0\r\n\r\n")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    yield server
+    server.close()
+
+@pytest.fixture
+def limiter():
+    return RateLimiter(requests_per_min=100000, tokens_per_min=10**8)
+
+@pytest.fixture
+def agent(stub, limiter, tmp_path):
+    return Groq_Agent("test-key", base_url=stub.url, log_file=str(tmp_path / "llm_log.jsonl"),
+                      rate_limiter=limiter, max_retries=3, router=ModelRouter())
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_retries_retryable_errors(agent, stub, status):
+    stub.script = [(status, {}), (status, {})]
+    _, response, output_tokens = agent.make_query("hi", stage="reply")
+    assert response == "hello there"
+    assert output_tokens == 2
+    assert len(stub.requests) == 3
+
+def test_honours_retry_after(agent, stub):
+    stub.script = [(429, {"retry-after": "1"})]
+    _, response, _ = agent.make_query("hi")
+    assert response == "hello there"
+    assert stub.requests[1] - stub.requests[0] >= 1.0
+
+@pytest.mark.parametrize("status", [400, 401, 404, 422])
+def test_fails_fast_on_client_errors(agent, stub, status):
+    stub.script = [(status, {})]
+    assert agent.make_query("hi") == (0, None, 0)
+    assert len(stub.requests) == 1
+    assert agent.failed_queries == 1
+
+def test_gives_up_after_max_retries(agent, stub):
+    # Slow refill (100 tokens/s), so a reservation that isn't handed back shows
+    agent.rate_limiter = limiter = RateLimiter(requests_per_min=100000, tokens_per_min=6000)
+    agent.max_retries = 1
+    stub.script = [(500, {}), (500, {})]
+    assert agent.make_query("hi") == (0, None, 0)
+    assert len(stub.requests) == 2
+    # Nothing was used: every attempt's reservation is handed back
+    limiter.tokens.refill()
+    assert limiter.tokens.level >= limiter.tokens.capacity - 100
+
+def test_client_error_keeps_the_primary_model(agent, stub):
+    stub.script = [(400, {})]
+    agent.make_query("hi", stage="reply")
+    assert not agent.router.pick("reply", agent.model).is_fallback
+
+def test_server_errors_switch_to_the_fallback(agent, stub):
+    agent.max_retries = 0
+    stub.script = [(503, {})]
+    agent.make_query("hi", stage="reply")
+    assert agent.router.pick("reply", agent.model).is_fallback
+
+def test_long_stream_with_a_quick_first_token_is_not_slow():
+    router = ModelRouter()
+    choice = router.pick("reply", "big-model")
+    for _ in range(3):
+        router.observe(choice, 20.0, 100, 1000, False, first_token=0.3)
+    assert not router.pick("reply", "big-model").is_fallback
+    router.observe(choice, 20.0, 100, 1000, False)
+    assert router.pick("reply", "big-model").is_fallback
+
+def test_fallback_answer_is_cached_under_the_fallback_model(agent, stub, tmp_path):
+    agent.cache = cache = ResponseCache(disk_path=str(tmp_path / "cache.sqlite"))
+    stub.script = [(503, {})]
+    agent.make_query("hi", temp=0.0, stage="reply")
+    key = lambda model: cache.make_key(model, agent.lang, DEFAULT_SYSTEM_PROMPT, "hi", 0.0)
+    assert cache.get(key(agent.model)) is None
+    assert cache.get(key(agent.router.route("reply").fallback)) is not None
+
+def test_async_retries(agent, stub):
+    stub.script = [(503, {})]
+    _, response, _ = asyncio.run(agent.make_query_async("hi"))
+    assert response == "hello there"
+    assert len(stub.requests) == 2
+
+def test_stream_retries_initial_request(agent, stub):
+    stub.script = [(429, {})]
+    assert "".join(agent.make_query_stream("hi")) == "hello there"
+    assert len(stub.requests) == 2
+
+
+def test_background_leaves_reserve_for_replies():
+    limiter = RateLimiter(requests_per_min=4, tokens_per_min=10**6, background_reserve=0.25)
+    granted = [limiter.try_acquire(10, PRIORITY_BACKGROUND) == 0 for _ in range(4)]
+    assert granted == [True, True, True, False]
+    assert limiter.try_acquire(10, PRIORITY_REPLY) == 0
+
+def test_background_waits_while_a_reply_is_waiting():
+    limiter = RateLimiter(requests_per_min=60, tokens_per_min=10**6)
+    limiter._mark_waiting(PRIORITY_REPLY, 1)
+    assert limiter.try_acquire(10, PRIORITY_BACKGROUND) > 0
+    assert limiter.try_acquire(10, PRIORITY_REPLY) == 0
+    limiter._mark_waiting(PRIORITY_REPLY, -1)
+    assert limiter.try_acquire(10, PRIORITY_BACKGROUND) == 0
+
+def test_reply_overtakes_a_waiting_background_call():
+    limiter = RateLimiter(requests_per_min=10**4, tokens_per_min=6000, background_reserve=0.25)
+    limiter.tokens.level = 0.0 # refills at 100 tokens/s, background also has to leave 1500 in the bucket
+    order = []
+    background = threading.Thread(target=lambda: (limiter.acquire(10, PRIORITY_BACKGROUND), order.append("background")), daemon=True)
+    reply = threading.Thread(target=lambda: (limiter.acquire(10, PRIORITY_REPLY), order.append("reply")))
+    background.start()
+    time.sleep(0.05)
+    started = time.monotonic()
+    reply.start()
+    reply.join(5)
+    assert order == ["reply"]
+    assert time.monotonic() - started < 1.0
@@ -0,0 +1,14 @@
+"""
+Small talk filter in front of learning.
+"""
+from learning_module import is_small_talk
+import pytest
+
+
+@pytest.mark.parametrize("message", ["hi", "lol ok", "Thanks!", "good morning :)", "", "..."])
+def test_small_talk_is_skipped(message):
+    assert is_small_talk(message)
+
+@pytest.mark.parametrize("message", ["Berlin", "Pregnant!", "I'm a nurse", "ok my sister is visiting"])
+def test_short_answers_are_learned(message):
+    assert not is_small_talk(message)
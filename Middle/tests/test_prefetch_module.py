@@ -0,0 +1,31 @@
+"""
+PrefetchCache: only finished speculations are reused, the rest is dropped and counted as wasted.
+"""
+from concurrent.futures import Future
+from metrics_module import metrics
+from prefetch_module import PrefetchCache
+
+DRAFT = "tell me about my hiking trip plans"
+
+
+def speculate(cache, finished):
+    future = Future()
+    entry = cache.start(DRAFT, "context", lambda entry: future)
+    if finished:
+        future.set_result(("new context", "facts"))
+    return entry, future
+
+def test_finished_speculation_is_reused():
+    cache = PrefetchCache()
+    entry, _ = speculate(cache, finished=True)
+    assert cache.take(DRAFT, "context") is entry
+
+def test_unfinished_speculation_is_dropped():
+    cache = PrefetchCache()
+    entry, future = speculate(cache, finished=False)
+    assert cache.take(DRAFT, "context") is None
+    assert future.cancelled()
+    # It was already running: what it still costs is wasted
+    wasted = metrics.counters.get("prefetch_wasted_tokens_total", 0)
+    cache.charge(entry, 50)
+    assert metrics.counters["prefetch_wasted_tokens_total"] == wasted + 50
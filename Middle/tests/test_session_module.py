@@ -0,0 +1,45 @@
+"""
+SessionPool: sessions belong to a user, ids are checked before they reach the disk.
+"""
+from fake_llm import FakeGroqAgent
+from retrieval_module import Memory
+from session_module import SessionPool
+import session_module
+import pytest
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(session_module, "Groq_Agent", lambda api_key, model, cache: FakeGroqAgent(model=model))
+    pool = SessionPool("test-key", kb_dir=str(tmp_path / "KB"))
+    yield pool
+    pool.close_all()
+
+
+def test_same_session_id_of_two_users_is_two_sessions(pool):
+    alice = pool.get("default", "alice")
+    bob = pool.get("default", "bob")
+    assert alice is not bob
+    assert bob.user_id == "bob"
+    assert alice.talker.memory is not bob.talker.memory
+    assert pool.get("default", "alice") is alice
+
+def test_new_user_gets_their_own_kb(pool, tmp_path):
+    pool.get("s1", "carol")
+    assert (tmp_path / "KB" / "users" / "carol" / "permanent.json").exists()
+
+@pytest.mark.parametrize("user_id", ["../../etc", "a/b", "", "x" * 65])
+def test_rejects_unsafe_user_ids(pool, user_id):
+    with pytest.raises(ValueError):
+        pool.get("s1", user_id)
+
+def test_shutdown_saves_learning_and_skips_wrap_up_past_the_deadline(pool, tmp_path):
+    talker = pool.get("s1", "dave").talker
+    talker.process_query("I moved to Berlin last year for a new job at a bakery")
+    llm, memory = talker.llm, talker.memory
+    greetings = llm.calls["greeting"]
+    pool.close_all(wrap_up_seconds=0)
+    assert llm.calls["learning"] > 0
+    assert llm.calls["greeting"] == greetings
+    saved = Memory(FakeGroqAgent(), str(tmp_path / "KB" / "users" / "dave" / "permanent.json"))
+    assert saved.data == memory.data
@@ -0,0 +1,64 @@
+"""
+Write-ahead logged KB stores: restarts, torn log tails, deleted domains, and the fact index after a restart.
+"""
+from benchmark import make_synthetic_kb, write_kb
+from fake_llm import FakeGroqAgent
+from migrate_kb import migrate
+from retrieval_module import Memory
+import os
+import pytest
+
+
+@pytest.fixture(params=["single", "sharded"])
+def kb_path(request, tmp_path):
+    path = write_kb(make_synthetic_kb(60), str(tmp_path))
+    if request.param == "sharded":
+        migrate(path)
+    return path
+
+def load(path):
+    return Memory(FakeGroqAgent(), path_to_permanent_data=path)
+
+
+def test_writes_survive_a_restart(kb_path):
+    memory = load(kb_path)
+    domain = memory.top_level_fields[0]
+    memory.change_subfield_and_fact(domain, "zebra", "plays the xylophone for zebras")
+    memory.write_to_disk()
+    memory = load(kb_path)
+    assert memory.data[domain]["zebra"] == "plays the xylophone for zebras"
+
+def test_restart_indexes_what_the_log_replayed(kb_path):
+    memory = load(kb_path)
+    domain = memory.top_level_fields[0]
+    memory.change_subfield_and_fact(domain, "zebra", "plays the xylophone for zebras")
+    memory.write_to_disk()
+    memory = load(kb_path)
+    assert "xylophone" in memory.retrieve("xylophone zebras")
+
+def test_torn_log_tail_is_dropped_and_later_writes_kept(kb_path):
+    memory = load(kb_path)
+    first, second = memory.top_level_fields[:2]
+    memory.change_subfield_and_fact(first, "before", "written before the crash")
+    memory.write_to_disk()
+    with open(memory.store.log_path, "a") as log:
+        log.write('{"op": "put", "domain": "')
+    memory = load(kb_path)
+    memory.change_subfield_and_fact(second, "after", "written after the crash")
+    memory.write_to_disk()
+    memory = load(kb_path)
+    assert memory.data[first]["before"] == "written before the crash"
+    assert memory.data[second]["after"] == "written after the crash"
+
+def test_deleted_domain_stays_deleted(kb_path):
+    memory = load(kb_path)
+    domain = memory.top_level_fields[0]
+    memory.data[domain] # load the shard, if there is one
+    assert memory.remove_top_level_field(domain)
+    memory.write_to_disk()
+    memory = load(kb_path)
+    assert domain not in memory.field_data
+    assert domain not in memory.data
+    if memory.sharded:
+        shards = os.listdir(os.path.join(memory.store.directory, "shards"))
+        assert len(shards) == len(memory.top_level_fields)
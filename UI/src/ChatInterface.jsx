@@ -5,6 +5,8 @@ const ChatInterface = () => {
   const [messages, setMessages] = useState([]);
   const [inputMessage, setInputMessage] = useState('');
   const messagesEndRef = useRef(null);
+  // Identifies this chat to the server, so concurrent chats don't share context
+  const sessionIdRef = useRef(crypto.randomUUID());
 
   // Auto-scroll to bottom when messages change
   const scrollToBottom = () => {
@@ -16,6 +18,24 @@ const ChatInterface = () => {
     scrollToBottom();
   }, [messages]);
 
+  // While the user types, send the draft (once they pause) so the server can look things up ahead of time
+  const lastPrefetchRef = useRef('');
+  useEffect(() => {
+    const draft = inputMessage.trim();
+    if (draft.length < 12 || draft === lastPrefetchRef.current) return;
+    const timer = setTimeout(() => {
+      lastPrefetchRef.current = draft;
+      fetch('http://127.0.0.1:5000/prefetch', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ message: draft, session_id: sessionIdRef.current })
+      }).catch(() => {}); // best effort, sending the message works the same without it
+    }, 600);
+    return () => clearTimeout(timer);
+  }, [inputMessage]);
+
   const handleSendMessage = async (e) => {
     e.preventDefault();
     
@@ -32,37 +52,70 @@ const ChatInterface = () => {
     const MAX_RETRIES = 10;
     let retryCount = 0;
 
+    const botMessageId = Date.now() + 1;
+
+    // Append a chunk of streamed text to the bot message, creating the message on the first chunk
+    const appendToBotMessage = (chunk) => {
+      setMessages(prevMessages => {
+        if (!prevMessages.some(message => message.id === botMessageId)) {
+          return [...prevMessages, { id: botMessageId, text: chunk, sender: 'bot' }];
+        }
+        return prevMessages.map(message =>
+          message.id === botMessageId ? { ...message, text: message.text + chunk } : message
+        );
+      });
+    };
+
     const sendMessageWithRetry = async () => {
+      let receivedAnything = false;
       try {
-        // Send POST request using fetch
-        const response = await fetch('http://127.0.0.1:5000/chat', {
+        // Send POST request and render the reply as it streams in (server-sent events)
+        const response = await fetch('http://127.0.0.1:5000/chat/stream', {
           method: 'POST',
           headers: {
             'Content-Type': 'application/json',
           },
-          body: JSON.stringify({ message: inputMessage })
+          body: JSON.stringify({ message: inputMessage, session_id: sessionIdRef.current })
         });
 
-        if (!response.ok) {
+        if (!response.ok || !response.body) {
           throw new Error('Network response was not ok');
         }
 
-        const data = await response.json();
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let done = false;
+
+        while (!done) {
+          const { value, done: streamDone } = await reader.read();
+          if (streamDone) break;
+          buffer += decoder.decode(value, { stream: true });
+
+          // Events are separated by a blank line, the last piece may still be incomplete
+          const events = buffer.split('\n\n');
+          buffer = events.pop();
+          for (const event of events) {
+            if (event.startsWith('event: done')) {
+              done = true;
+              break;
+            }
+            const dataLine = event.split('\n').find(line => line.startsWith('data: '));
+            if (!dataLine) continue;
+            const { token } = JSON.parse(dataLine.slice(6));
+            if (token) {
+              receivedAnything = true;
+              appendToBotMessage(token);
+            }
+          }
+        }
         console.log("I received the response");
-        
-        const reply = data['response'];
-        // Add chatbot response to chat
-        const botMessage = {
-          id: Date.now() + 1,
-          text: reply,
-          sender: 'bot'
-        };
-        setMessages(prevMessages => [...prevMessages, botMessage]);
 
       } catch (error) {
         console.error(`Attempt ${retryCount + 1} failed:`, error);
-        
-        if (retryCount < MAX_RETRIES) {
+
+        // Only retry if nothing has been shown yet, otherwise we'd duplicate the reply
+        if (!receivedAnything && retryCount < MAX_RETRIES) {
           retryCount++;
           // Exponential backoff: wait increases with each retry
           const waitTime = Math.pow(2, retryCount) * 1000; 